@@ -0,0 +1,65 @@
+"""
+Compare per-enemy move_to_avoiding with the batched NumPy steering
+
+    python3 bench_steering.py [-n ITERATIONS] [-c COUNTS ...]
+
+Enemies are spread at the same density for every count (about as crowded
+as a busy screen), all of them chasing a player in the middle. Reports mean
+milliseconds per steering step for each path.
+"""
+import argparse
+import os
+import timeit
+import uuid
+from math import sqrt
+from random import randint, seed
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame as pg
+
+from broadphase import SpatialHash
+from entity import Enemy, Entity
+from steering import steer_batch
+
+def make_enemies(count: int) -> list[Enemy]:
+    # 1000 enemies to a 1280x720 screen, the area grows with the count
+    scale = sqrt(count / 1000)
+    width, height = int(1280 * scale), int(720 * scale)
+    return [Enemy(pg.Vector2(randint(0, width), randint(0, height)), None, uuid.uuid4(), None)
+            for _ in range(count)]
+
+def per_object(enemies: list[Enemy], destination: pg.Vector2, dt: float) -> None:
+    rects = {e.uuid: e.get_rect() for e in enemies}
+    grid = SpatialHash()
+    grid.rebuild(rects)
+    for enemy in enemies:
+        enemy.move_to_avoiding(destination, rects, dt, grid)
+
+def batched(enemies: list[Enemy], destination: pg.Vector2, dt: float) -> None:
+    steer_batch(enemies, destination, {e.uuid: e.get_rect() for e in enemies}, dt)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--iterations", help="Timing iterations per count", type=int, default=10)
+    parser.add_argument("-c", "--counts", help="Enemy counts to time", type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    args = parser.parse_args()
+
+    pg.init()
+    # Time the steering, not the rects moving around between runs
+    Entity.update = lambda self, dt, bounds=None: None
+    print(f'{"enemies":>8} {"per-object ms":>14} {"batched ms":>11} {"speedup":>8}')
+    for count in args.counts:
+        seed(count)
+        enemies = make_enemies(count)
+        destination = enemies[0].get_location()
+        times = {}
+        for name, step in (('per-object', per_object), ('batched', batched)):
+            times[name] = timeit.timeit(lambda: step(enemies, destination, 1/60),
+                                        number=args.iterations) / args.iterations
+        print(f'{count:8d} {times["per-object"] * 1e3:14.2f} {times["batched"] * 1e3:11.2f} '
+              f'{times["per-object"] / times["batched"]:7.1f}x')
+
+if __name__ == '__main__':
+    main()
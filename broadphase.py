@@ -0,0 +1,127 @@
+"""
+Uniform grid broadphase for the client's collision and avoidance checks
+
+Rects are bucketed by the grid cells they cover, queries only test rects
+sharing a cell with the query rect instead of every rect in the scene.
+"""
+import heapq
+from math import hypot, inf
+
+import pygame as pg
+
+class SpatialHash:
+    def __init__(self, cell_size: int = 32) -> None:
+        self.cell_size = cell_size
+        self._cells: dict[tuple[int,int], list] = {}
+        self._rects: dict = {}
+        self._extent: list[int]|None = None  # [min_x, min_y, max_x, max_y] cells in use
+
+    def __len__(self) -> int:
+        return len(self._rects)
+
+    def __contains__(self, key) -> bool:
+        return key in self._rects
+
+    def _span(self, rect: pg.Rect) -> tuple[int,int,int,int]:
+        size = self.cell_size
+        return rect.left // size, rect.top // size, (rect.right - 1) // size, (rect.bottom - 1) // size
+
+    def clear(self) -> None:
+        self._cells.clear()
+        self._rects.clear()
+        self._extent = None
+
+    def insert(self, key, rect: pg.Rect) -> None:
+        self._rects[key] = rect
+        min_x, min_y, max_x, max_y = self._span(rect)
+        cells = self._cells
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                if (cx, cy) in cells:
+                    cells[(cx, cy)].append(key)
+                else:
+                    cells[(cx, cy)] = [key]
+        extent = self._extent
+        if extent is None:
+            self._extent = [min_x, min_y, max_x, max_y]
+        else:
+            extent[0], extent[1] = min(extent[0], min_x), min(extent[1], min_y)
+            extent[2], extent[3] = max(extent[2], max_x), max(extent[3], max_y)
+
+    def rebuild(self, rects: dict) -> None:
+        """
+        Replace the contents with rects ({key: rect}), the rects are kept by reference
+        """
+        self.clear()
+        for key, rect in rects.items():
+            self.insert(key, rect)
+
+    def candidates(self, rect: pg.Rect) -> set:
+        """
+        Keys of every rect sharing a cell with rect, may include ones that don't overlap it
+        """
+        found = set()
+        min_x, min_y, max_x, max_y = self._span(rect)
+        cells = self._cells
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                if (cx, cy) in cells:
+                    found.update(cells[(cx, cy)])
+        return found
+
+    def collide(self, rect: pg.Rect) -> list[tuple]:
+        """
+        Like rect.collidedictall(rects, values=True), [(key, rect)] of every rect overlapping rect
+        """
+        rects = self._rects
+        return [(key, rects[key]) for key in self.candidates(rect) if rect.colliderect(rects[key])]
+
+    def collide_first(self, rect: pg.Rect) -> tuple|None:
+        """
+        Like rect.collidedict(rects, values=True), (key, rect) of a rect overlapping rect or None
+        """
+        rects = self._rects
+        for key in self.candidates(rect):
+            if rect.colliderect(rects[key]):
+                return key, rects[key]
+        return None
+
+    def nearest(self, x: float, y: float, k: int = 1, max_distance: float = inf) -> list[tuple]:
+        """
+        [(key, distance)] of the k rects whose centres are closest to (x, y) and
+        no further than max_distance, closest first. Searches rings of cells
+        outwards from (x, y) and stops once no unsearched cell can hold anything closer.
+        """
+        if not self._rects or k < 1:
+            return []
+        size = self.cell_size
+        cells = self._cells
+        rects = self._rects
+        min_x, min_y, max_x, max_y = self._extent
+        px, py = int(x // size), int(y // size)
+        # Ring after which every cell in use has been searched
+        last_ring = max(px - min_x, max_x - px, py - min_y, max_y - py, 0)
+        best = []  # max-heap of (-distance, order, key), the k closest so far
+        seen = set()
+        order = 0
+        for ring in range(last_ring + 1):
+            # Anything in a cell on this ring is at least this far away
+            if (ring - 1) * size > max_distance or (len(best) == k and (ring - 1) * size >= -best[0][0]):
+                break
+            for cx in range(px - ring, px + ring + 1):
+                edge = cx == px - ring or cx == px + ring
+                for cy in (range(py - ring, py + ring + 1) if edge else (py - ring, py + ring)):
+                    for key in cells.get((cx, cy), ()):
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        centre = rects[key].center
+                        distance = hypot(centre[0] - x, centre[1] - y)
+                        if distance > max_distance:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-distance, order, key))
+                        elif distance < -best[0][0]:
+                            heapq.heapreplace(best, (-distance, order, key))
+                        order += 1
+        return [(key, -distance) for distance, _, key in sorted(best, reverse=True)]
@@ -1,13 +1,16 @@
 from __future__ import annotations # To make type hinting work when using classes within this file
-from sprite_sheet import AnimatedSprite, SpriteSet
+from sprite_sheet import AnimatedSprite, SpriteSet, circle_mask
+from broadphase import SpatialHash
 import pygame as pg
+from collections import deque
 from math import radians
 from random import randint
 import time
 import logging
 import uuid
 
-from particle import Particle
+from particle import ParticleSystem
+from text import get_font, render_text
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -34,8 +37,10 @@ class Entity:
         self.is_alive = True
         self._name = name
         self._type = 'entity'
-        self._font = pg.font.SysFont('Futura', 30)
+        self._font = get_font('Futura', 30)
         self._draw_hp = True
+        # (local time, left, top) of the positions the server sent for a remote entity, oldest first
+        self._positions: deque[tuple[float,float,float]] = deque(maxlen=32)
 
     @staticmethod
     def from_dict(entity: dict, sprite_list: SpriteSet, e_uuid: uuid.UUID) -> Entity:
@@ -65,6 +70,7 @@ class Entity:
         self._velocity = pg.Vector2(0,0)
         self._hp = self._max_hp
         self.is_alive = True
+        self._positions.clear()
 
     def heal(self):
         self._hp = self._max_hp
@@ -86,24 +92,29 @@ class Entity:
             target_velocity = target_velocity.normalize() * self._max_velocity
         self._velocity = target_velocity
 
-    def move_to_avoiding(self, destination: pg.Vector2, avoid_list: dict[str,Entity], dt:float) -> None:
+    def move_to_avoiding(self, destination: pg.Vector2, avoid_list: dict[str,pg.Rect], dt:float,
+                         broadphase: SpatialHash=None) -> None:
         logger.debug(f'move_to_avoiding: Moving {self.uuid=} towards {destination=}')
         # Determine target velocity towards the player
         self.move_to(destination)
         target_velocity = pg.Vector2(0, 0)
 
-        collide_list = self.get_rect().collidedictall(avoid_list, values=True)
+        if broadphase is not None:
+            collide_list = broadphase.collide(self.get_rect())
+        else:
+            collide_list = self.get_rect().collidedictall(avoid_list, values=True)
 
         # Check for collision with other avoid_list
+        location = self.get_location()
         for o_uuid, o_rect in collide_list:
-            distance = self.get_location().distance_to(avoid_list[o_uuid].center)
+            distance = location.distance_to(o_rect.center)
             if distance: # if distance is 0, assume this is us and skip
-                collision_radius = avoid_list[o_uuid].width
+                collision_radius = o_rect.width
 
                 if distance < collision_radius:
 
                     # Calculate a direction vector to avoid the other entity
-                    direction = self.get_location() - avoid_list[o_uuid].center
+                    direction = location - o_rect.center
 
                     # Move away from the other entity
                     target_velocity += direction * self._max_velocity # Adjust strength as needed
@@ -137,9 +148,7 @@ class Entity:
         if self._sprite:
             return self._sprite.get_mask(flip=self._facing_left)
         else:
-            surface = pg.Surface((20,20), pg.SRCALPHA)
-            pg.draw.circle(surface, (255,0,0,255), (10,10), radius=10, width=0)
-            return pg.mask.from_surface(surface)
+            return circle_mask()
 
     def get_location(self) -> pg.Vector2:
         return pg.Vector2(self._sprite.rect.centerx, self._sprite.rect.centery)
@@ -167,17 +176,82 @@ class Entity:
     def update_animation(self):
         self._sprite.update_animation()
 
-    def net_update(self, remote_entity:dict) -> None:
+    def add_position(self, timestamp: float, left: float, top: float) -> None:
+        self._positions.append((timestamp, left, top))
+        if len(self._positions) == 1:
+            self._sprite.rect.topleft = (left, top)
+
+    def hold_position(self, timestamp: float) -> None:
+        """
+        The server had nothing new for this entity at timestamp, so it was still
+        where it was last seen. Without this a stopped entity keeps its last
+        heading and gets drawn past where it stopped.
+        """
+        positions = self._positions
+        if not positions or timestamp <= positions[-1][0]:
+            return
+        left, top = positions[-1][1:]
+        if len(positions) >= 2 and positions[-2][1:] == (left, top):
+            # Already standing still, move the last sample on rather than filling the buffer
+            positions[-1] = (timestamp, left, top)
+        else:
+            positions.append((timestamp, left, top))
+
+    def interpolate(self, render_time: float, max_extrapolation: float=0.25) -> None:
+        """
+        Place a remote entity where it was at render_time (local clock) going by
+        the positions the server sent, carrying on along its last heading for up
+        to max_extrapolation seconds past the newest one
+        """
+        positions = self._positions
+        if len(positions) < 2:
+            return
+        newest = positions[-1]
+        if render_time >= newest[0]:
+            before = positions[-2]
+            after = newest
+            render_time = min(render_time, newest[0] + max_extrapolation)
+        elif render_time <= positions[0][0]:
+            self._sprite.rect.topleft = positions[0][1:]
+            return
+        else:
+            index = len(positions) - 2
+            while positions[index][0] > render_time:
+                index -= 1
+            before = positions[index]
+            after = positions[index + 1]
+        span = after[0] - before[0]
+        if span <= 0:
+            self._sprite.rect.topleft = after[1:]
+            return
+        t = (render_time - before[0]) / span
+        self._sprite.rect.topleft = (round(before[1] + (after[1] - before[1]) * t),
+                                     round(before[2] + (after[2] - before[2]) * t))
+
+    def net_update(self, remote_entity:dict, timestamp: float|None=None) -> None:
+        # remote_entity may be a partial update holding only the changed fields,
+        # with a timestamp the position is buffered for interpolate instead of snapped to
         try:
             logger.debug(f'net_update: {remote_entity=}')
-            left = remote_entity['location']['x']
-            top = remote_entity['location']['y']
-            self._sprite.rect.update(left, top, self._sprite.rect.width, self._sprite.rect.height)
-            self._velocity.x = remote_entity['velocity']['x']
-            self._velocity.y = remote_entity['velocity']['y']
-            self._facing_left = remote_entity['facing_left']
-            self.is_alive = remote_entity['is_alive']
-            self._hp = remote_entity['hp']
+            if remote_entity.get('is_alive') and not self.is_alive:
+                # Respawned somewhere else, don't slide there from where it died
+                self._positions.clear()
+            if 'location' in remote_entity:
+                left = remote_entity['location']['x']
+                top = remote_entity['location']['y']
+                if timestamp is None:
+                    self._sprite.rect.update(left, top, self._sprite.rect.width, self._sprite.rect.height)
+                else:
+                    self.add_position(timestamp, left, top)
+            if 'velocity' in remote_entity:
+                self._velocity.x = remote_entity['velocity']['x']
+                self._velocity.y = remote_entity['velocity']['y']
+            if 'facing_left' in remote_entity:
+                self._facing_left = remote_entity['facing_left']
+            if 'is_alive' in remote_entity:
+                self.is_alive = remote_entity['is_alive']
+            if 'hp' in remote_entity:
+                self._hp = remote_entity['hp']
         except Exception as e:
             logger.error(f'{e=} {remote_entity}')
         
@@ -203,11 +277,11 @@ class Entity:
         pg.draw.rect(screen, (255,0,0,255),bar)
         pg.draw.rect(screen, (0,0,0,255),rect,1,1)
 
-    def draw(self, screen, color=(255,0,0,255)) -> None:
+    def draw(self, screen, color=(255,0,0,255), batch: list|None=None) -> None:
         if self._draw_hp: self.draw_healthbar(screen)
-        self._sprite.draw(screen, flip=self._facing_left, color=color)
+        self._sprite.draw(screen, flip=self._facing_left, color=color, batch=batch)
         if self._name:
-            name = self._font.render(self._name, True, (0, 0, 0))
+            name = render_text(self._font, self._name, (0, 0, 0))
             name_pos = self.get_location()
             name_pos.x -= name.get_width()/2
             name_pos.y += self._sprite.rect.height/2
@@ -241,13 +315,14 @@ class Enemy(Entity):
 
     def serialize(self) -> dict:
         ret_val = super().serialize()
-        ret_val['target'] = str(self.target)
+        ret_val['target'] = str(self.target) if self.target else None
         ret_val['type'] = 'enemy'
         return ret_val
 
-    def net_update(self, remote_entity: dict) -> None:
-        super().net_update(remote_entity)
-        self.target = None if remote_entity['target'] == None else uuid.UUID(remote_entity['target'])
+    def net_update(self, remote_entity: dict, timestamp: float|None=None) -> None:
+        super().net_update(remote_entity, timestamp)
+        if 'target' in remote_entity:
+            self.target = None if remote_entity['target'] == None else uuid.UUID(remote_entity['target'])
 
     def move_to_target(self, player_position_list:list) -> None:
         for player in player_position_list:
@@ -259,7 +334,7 @@ class Player(Entity):
         self._color = (0,0,128,255)
         self._max_velocity = 450
         self._type = 'player'
-        self.attack_particles: dict[str,Particle] = {}
+        self.attack_particles: ParticleSystem = ParticleSystem()
         self._last_attack = 0
         self._attack_timer = 0
         self._next_attack = 500
@@ -291,17 +366,14 @@ class Player(Entity):
                 self._velocity = target_velocity
         logger.debug(f'player:update: {self._velocity.length()}')
         super().update(dt, bounds)
-        completes = [a for a in self.attack_particles if self.attack_particles[a].complete]
-        for c in completes:
-            del self.attack_particles[c]
-        [self.attack_particles[a].update(dt) for a in self.attack_particles]
+        self.attack_particles.update(dt)
 
     def attack(self, closest_point:pg.Vector2, dt:float, ticks:float ):
         if self.is_alive:
             self._attack_timer += (dt*1000)
             if self._last_attack + self._attack_timer >= self._last_attack + self._next_attack:
                 ptcl_uuid = str(uuid.uuid4())
-                self.attack_particles[ptcl_uuid] = Particle(time.time(), self.get_location(), closest_point - self.get_location())
+                self.attack_particles.spawn(ptcl_uuid, time.time(), self.get_location(), closest_point - self.get_location())
                 self._last_attack = ticks
                 self._attack_timer = 0
 
@@ -311,6 +383,5 @@ class Player(Entity):
         return ret_val
     
     def draw(self, screen) -> None:
-        for _, particle in self.attack_particles.items():
-            if not particle.complete: particle.draw(screen,color=(41,45,41,255))
+        self.attack_particles.draw(screen, color=(41,45,41,255))
         super().draw(screen, color=self._color)
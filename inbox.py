@@ -0,0 +1,108 @@
+"""
+Thread safe queue of decoded server messages for the game loop
+
+The websocket thread puts messages in, Scene.update takes them out at the
+top of the frame, so nothing touches the scene's entities from the network
+thread. A message arriving while the last one is still waiting is folded
+into it where that's safe: a newer snapshot against the same baseline
+replaces the older one, one against the older one is composed with it, and
+events for the same entity keep only the latest. A snapshot is never folded
+into older events for the entities it has in it.
+"""
+import logging
+import threading
+from collections import deque
+
+from server.codec import OPPOSITES
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+SNAPSHOT_KEYS = ('seq', 'baseline', 'entities', 'despawned')
+REPLACE_KEYS = ('scores', 'pickups_live')  # each one is the whole state, not an update to merge
+
+def merge_snapshots(older: dict, newer: dict) -> dict|None:
+    """
+    The snapshot fields of newer folded into older, None if they can't be
+    (newer is against a baseline we wouldn't have without applying older)
+    """
+    if 'seq' not in older:
+        return {key: newer[key] for key in SNAPSHOT_KEYS if key in newer}
+    if 'seq' not in newer:
+        return {key: older[key] for key in SNAPSHOT_KEYS if key in older}
+    if newer.get('baseline') is None or newer.get('baseline') == older.get('baseline'):
+        # A delta against the same baseline already holds everything the older one did
+        return {key: newer[key] for key in SNAPSHOT_KEYS if key in newer}
+    if newer['baseline'] != older['seq']:
+        return None
+    entities = {r_uuid: dict(fields) for r_uuid, fields in older.get('entities', {}).items()}
+    for r_uuid, fields in newer.get('entities', {}).items():
+        entities[r_uuid] = {**entities[r_uuid], **fields} if r_uuid in entities else fields
+    despawned = [r_uuid for r_uuid in older.get('despawned', []) if r_uuid not in entities]
+    for r_uuid in newer.get('despawned', []):
+        entities.pop(r_uuid, None)
+        if r_uuid not in despawned:
+            despawned.append(r_uuid)
+    merged = {'seq': newer['seq'], 'baseline': older.get('baseline')}
+    if entities: merged['entities'] = entities
+    if despawned: merged['despawned'] = despawned
+    return merged
+
+def coalesce(older: dict, newer: dict) -> dict|None:
+    """
+    One message with the effect of handling older then newer, None if they
+    have to be handled separately
+    """
+    if 'seq' in newer:
+        # handle_message applies the snapshot before the events, so an older event
+        # (a kill, a spawn) for an entity in the newer snapshot would undo it
+        touched = newer.get('entities', {}).keys() | set(newer.get('despawned', ()))
+        if touched and any(isinstance(value, dict) and not touched.isdisjoint(value)
+                           for key, value in older.items() if key not in SNAPSHOT_KEYS):
+            return None
+    snapshot = merge_snapshots(older, newer)
+    if snapshot is None:
+        return None
+    merged = {key: value for key, value in older.items() if key not in SNAPSHOT_KEYS}
+    if 'particles' in older and 'offset' in older and 'offset' in newer:
+        # Particles get the merged message's offset taken off, keep the older ones' start time right
+        shift = newer['offset'] - older['offset']
+        merged['particles'] = {p_uuid: {**particle, 'start_time': particle['start_time'] + shift}
+                               for p_uuid, particle in older['particles'].items()}
+    for key, value in newer.items():
+        if key in SNAPSHOT_KEYS:
+            continue
+        if key in OPPOSITES and OPPOSITES[key] in merged:
+            merged[OPPOSITES[key]] = {r_uuid: v for r_uuid, v in merged[OPPOSITES[key]].items()
+                                      if r_uuid not in value}
+        if isinstance(value, dict) and isinstance(merged.get(key), dict) and key not in REPLACE_KEYS:
+            merged[key] = {**merged[key], **value}
+        else:
+            merged[key] = value
+    merged.update(snapshot)
+    return merged
+
+class Inbox:
+    def __init__(self) -> None:
+        self._messages: deque[dict] = deque()
+        self._lock = threading.Lock()
+        self.received: int = 0
+        self.coalesced: int = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def put(self, data: dict) -> None:
+        with self._lock:
+            self.received += 1
+            if self._messages:
+                merged = coalesce(self._messages[-1], data)
+                if merged is not None:
+                    self._messages[-1] = merged
+                    self.coalesced += 1
+                    return
+            self._messages.append(data)
+
+    def get(self) -> dict|None:
+        with self._lock:
+            return self._messages.popleft() if self._messages else None
@@ -21,7 +21,11 @@ parser = argparse.ArgumentParser()
 parser.add_argument("-n", "--name", help="Player name", required=False)
 parser.add_argument("-u", "--url", help="Server URL to connect to, or IP to listen on as server", required=False, default="localhost")
 parser.add_argument("-p", "--port", help="Server port to connect to, or listen on as server", required=False, default=8765)
+parser.add_argument("-s", "--send-rate", help="Updates sent to the server per second, independent of the frame rate", type=float, required=False, default=20)
+parser.add_argument("-i", "--interpolation-delay", help="Seconds in the past remote entities are drawn at, smooths out low network rates", type=float, required=False, default=0.1)
+parser.add_argument("-r", "--room", help="Room to join on a server running rooms, one is picked if not given", required=False)
 parser.add_argument("-d", "--debug", help="Run with debug flags", action='store_true')
+parser.add_argument("--profile-csv", help="With --debug, write the per-frame phase timings to this CSV file", required=False)
 args = parser.parse_args()
 
 DEBUG = args.debug
@@ -71,15 +75,18 @@ scene = None
 #     scene = Scene(debug=DEBUG, server=server, port=port)
 #     print("Server starting, press ctrl+c to exit.")
 # else:
-scene = Scene(name, debug=DEBUG, url=url, port=port, p_uuid=p_uuid)
+scene = Scene(name, debug=DEBUG, url=url, port=port, p_uuid=p_uuid, send_rate=args.send_rate,
+              interpolation_delay=args.interpolation_delay, profile_csv=args.profile_csv, room=args.room)
 
 while running:
+    scene.profiler.begin_frame()
     # poll for events
     # pygame.QUIT event means the user clicked X to close your window
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             scene.quit()
             running = False
+    scene.profiler.lap('events')
     
     # update the current scene
     scene.update(dt)
@@ -90,14 +97,18 @@ while running:
 
     # draw current scene
     scene.draw()
+    scene.profiler.lap('draw')
 
     # flip() the display to put your work on screen
     pygame.display.flip()
+    scene.profiler.lap('flip')
 
     # limits FPS to 60
     # dt is delta time in seconds since last frame, used for framerate-
     # independent physics.
     dt = clock.tick(60) / 1000
+    scene.profiler.lap('idle')
+    scene.profiler.end_frame(scene.counts())
 
 scene.quit()
 pygame.quit()
@@ -3,22 +3,35 @@ import threading
 import websocket
 import logging
 
+from server.codec import CODECS, JSON, decode, encode
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 class WebSocketClient:
-    def __init__(self, uri):
+    def __init__(self, uri, codecs: list[str]=None, room: str|None=None):
         self.uri = uri
         self.ws = None
         self.running = False
         self.message_handler = None
+        self.codec = JSON
+        self._codecs = list(CODECS) if codecs is None else codecs  # offered to the server, in order of preference
+        self._handshake_sent = False
+        self.room = room  # asked for in the handshake, the server tells us the one we got
 
     def on_message(self, ws, message):
         logger.debug(f'on_message:Received message: {type(message)=} {message=}')  # Log the raw message
+        logger.debug(f'on_message:Received {len(message)} bytes')
         try:
-            # data = json.loads(message)
+            data = decode(message)
+            if 'codec' in data:
+                self.codec = CODECS.get(data['codec'], JSON)
+                logger.info(f'on_message:Server selected {self.codec.name} codec')
+            if 'room' in data:
+                self.room = data['room']
+                logger.info(f'on_message:Joined room {self.room}')
             if self.message_handler:
-                self.message_handler(message)
+                self.message_handler(data)
         except json.JSONDecodeError as e:
             logger.error(f'on_message:JSON decode error:1: {e=}')
             logger.error(f'on_message:JSON decode error:2: {message=}')
@@ -48,6 +61,8 @@ class WebSocketClient:
         self.connect()
 
     def connect(self):
+        self.codec = JSON
+        self._handshake_sent = False
         self.ws = websocket.WebSocketApp(self.uri,
                                         on_message=self.on_message,
                                         on_error=self.on_error,
@@ -62,14 +77,29 @@ class WebSocketClient:
         self.running = False
         self.ws.close()
 
-    def send(self, data):
+    @property
+    def needs_handshake(self) -> bool:
+        return not self._handshake_sent
+
+    def send(self, data) -> bool:
         if self.ws and self.running:
             try:
-                message = json.dumps(data)
-                self.ws.send(message)
+                if not self._handshake_sent:
+                    # The first message is the handshake, offer the codecs we understand
+                    data = {**data, 'codecs': self._codecs}
+                    if self.room is not None:
+                        data['room'] = self.room
+                message = encode(data, self.codec)
+                if isinstance(message, bytes):
+                    self.ws.send(message, opcode=websocket.ABNF.OPCODE_BINARY)
+                else:
+                    self.ws.send(message)
+                self._handshake_sent = True
+                return True
             except websocket.WebSocketConnectionClosedException:
                 print("WebSocket connection is closed. Attempting to reconnect...")
                 self.reconnect()
+        return False
 
     def set_message_handler(self, handler):
         self.message_handler = handler
\ No newline at end of file
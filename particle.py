@@ -1,5 +1,15 @@
-from __future__ import annotations # To make type hinting work when using classes within this file
+"""
+Particles kept in NumPy columns, one slot per particle
+
+Particles only ever fly in a straight line, so each one is its origin,
+direction, speed and age, and every position is worked out at once from
+those. Slots of finished particles are reused, the columns only grow when
+they are all in use. Every particle of a size and colour is the same dot,
+rendered once and blitted in one Surface.blits call.
+"""
 import logging
+
+import numpy as np
 import pygame as pg
 
 from sprite_sheet import AnimatedSprite
@@ -7,71 +17,160 @@ from sprite_sheet import AnimatedSprite
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-class Particle:
-    def __init__(self, start_time:float, origin:pg.Vector2, direction:pg.Vector2, speed:int=600, lifetime:float=1000, type='particle', radius=5) -> None:
-        self._origin: pg.Vector2 = origin
-        self._direction: pg.Vector2 = direction.normalize()
-        self._speed: int = speed
-        self._lifetime: float = lifetime
-        self._start_time: float = start_time
-        self._time_alive: float = 0
-        self._sprite: AnimatedSprite = AnimatedSprite(None, origin, radius=radius)
-        self._type: str = type
-        self.new: bool = True
-        self.complete: bool = False
-
-    @staticmethod
-    def from_dict(particle:dict, current_tick:float) -> Particle:
-        new_particle = Particle(
-            particle['start_time'],
-            pg.Vector2(particle['origin']['x'], particle['origin']['y']),
-            pg.Vector2(particle['direction']['x'], particle['direction']['y']),
-            speed=particle['speed'],
-            lifetime=particle['lifetime'],
-            type=particle['type'],
-            radius=particle['radius']
-        )
+# column name -> dtype
+_COLUMNS = {
+    'origin_x': np.float64,
+    'origin_y': np.float64,
+    'direction_x': np.float64,
+    'direction_y': np.float64,
+    'speed': np.float64,
+    'start_time': np.float64,
+    'lifetime': np.float64,  # ms
+    'age': np.float64,  # ms
+    'radius': np.int32,
+    'x': np.float64,
+    'y': np.float64,
+    'used': np.bool_,  # slot holds a particle, finished or not
+    'alive': np.bool_,  # still drawn and colliding
+    'new': np.bool_,  # created since the last update, not sent to the server yet
+}
+
+class ParticleSystem:
+    def __init__(self, capacity: int=64) -> None:
+        self._capacity = 0
+        self.columns: dict[str, np.ndarray] = {name: np.zeros(0, dtype) for name, dtype in _COLUMNS.items()}
+        self._ids: list[str|None] = []
+        self._slots: dict[str, int] = {}
+        self._free: list[int] = []
+        self._types: dict[int, str] = {}  # slot -> type, when it isn't 'particle'
+        self._dots: dict[tuple, pg.Surface] = {}  # (radius, colour) -> dot surface
+        self._grow(capacity)
+
+    def _grow(self, capacity: int) -> None:
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self._capacity] = column
+            self.columns[name] = grown
+        self._free.extend(range(capacity - 1, self._capacity - 1, -1))
+        self._ids.extend([None] * (capacity - self._capacity))
+        logger.debug(f'_grow: {self._capacity} -> {capacity} slots')
+        self._capacity = capacity
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, p_uuid: str) -> bool:
+        return p_uuid in self._slots
+
+    def spawn(self, p_uuid: str, start_time: float, origin: pg.Vector2, direction: pg.Vector2, speed: float=600,
+              lifetime: float=1000, type: str='particle', radius: int=5, age: float=0) -> None:
+        if p_uuid in self._slots:
+            self._release(self._slots[p_uuid])
+        if not self._free:
+            self._grow(self._capacity * 2)
+        slot = self._free.pop()
+        if direction.length_squared():
+            direction = direction.normalize()
+        c = self.columns
+        c['origin_x'][slot] = origin.x
+        c['origin_y'][slot] = origin.y
+        c['direction_x'][slot] = direction.x
+        c['direction_y'][slot] = direction.y
+        c['speed'][slot] = speed
+        c['start_time'][slot] = start_time
+        c['lifetime'][slot] = lifetime
+        c['age'][slot] = age
+        c['radius'][slot] = radius or 10
+        c['x'][slot] = origin.x + direction.x * speed * age / 1000
+        c['y'][slot] = origin.y + direction.y * speed * age / 1000
+        c['used'][slot] = True
+        c['alive'][slot] = age < lifetime
+        c['new'][slot] = True
+        if type != 'particle':
+            self._types[slot] = type
+        self._ids[slot] = p_uuid
+        self._slots[p_uuid] = slot
+
+    def add_dict(self, p_uuid: str, particle: dict, now: float) -> None:
+        """
+        A particle from the server, moved on to where it is by now
+        """
         # Chances are the particle was created before we received it
-        # Move it to its current location
-        logger.debug(f'from_dict: {new_particle.get_rect()} before catch up')
-        if current_tick != particle['start_time']:
-            dt = current_tick - particle['start_time']
-            logger.debug(f'from_dict: {dt=}')
-            new_particle.update(dt)
-        logger.debug(f'from_dict: {new_particle.get_rect()} after catch up')
-        return new_particle
-    
-    def serialize(self):
+        self.spawn(p_uuid, particle['start_time'],
+                   pg.Vector2(particle['origin']['x'], particle['origin']['y']),
+                   pg.Vector2(particle['direction']['x'], particle['direction']['y']),
+                   speed=particle['speed'], lifetime=particle['lifetime'], type=particle['type'],
+                   radius=int(particle['radius']), age=max(now - particle['start_time'], 0) * 1000)
+
+    def serialize(self, p_uuid: str) -> dict:
+        slot = self._slots[p_uuid]
+        c = self.columns
         return {
-            'start_time': self._start_time,
-            'origin': {
-                'x': self._origin.x,
-                'y': self._origin.y
-                },
-            'direction': {
-                'x': self._direction.x,
-                'y': self._direction.y
-                },
-            'speed': self._speed,
-            'lifetime': self._lifetime,
-            'type': self._type,
-            'radius': self._sprite.rect.width/2
+            'start_time': float(c['start_time'][slot]),
+            'origin': {'x': float(c['origin_x'][slot]), 'y': float(c['origin_y'][slot])},
+            'direction': {'x': float(c['direction_x'][slot]), 'y': float(c['direction_y'][slot])},
+            'speed': float(c['speed'][slot]),
+            'lifetime': float(c['lifetime'][slot]),
+            'type': self._types.get(slot, 'particle'),
+            'radius': int(c['radius'][slot]),
         }
 
-    def get_rect(self):
-        return self._sprite.rect
+    def new_particles(self) -> dict[str, dict]:
+        return {self._ids[slot]: self.serialize(self._ids[slot]) for slot in np.flatnonzero(self.columns['new'])}
+
+    def _release(self, slot: int) -> None:
+        del self._slots[self._ids[slot]]
+        self._ids[slot] = None
+        self._types.pop(slot, None)
+        self.columns['used'][slot] = False
+        self.columns['alive'][slot] = False
+        self._free.append(slot)
+
+    def complete(self, p_uuid: str) -> None:
+        """
+        Stop drawing and colliding with a particle, its slot goes at the next update
+        """
+        slot = self._slots.get(p_uuid)
+        if slot is not None:
+            self.columns['alive'][slot] = False
+
+    def update(self, dt: float) -> None:
+        c = self.columns
+        for slot in np.flatnonzero(c['used'] & ~c['alive']):
+            self._release(int(slot))
+        c['new'][:] = False
+        alive = c['alive']
+        c['age'][alive] += dt * 1000
+        seconds = c['age'] * c['speed'] / 1000
+        np.add(c['origin_x'], c['direction_x'] * seconds, out=c['x'], where=alive)
+        np.add(c['origin_y'], c['direction_y'] * seconds, out=c['y'], where=alive)
+        alive &= c['age'] < c['lifetime']
+
+    def _alive(self) -> tuple[np.ndarray, list[int], list[int], list[int]]:
+        c = self.columns
+        slots = np.flatnonzero(c['alive'])
+        radius = c['radius'][slots]
+        # Same rect as the old per-particle sprite, a 2r square on the position
+        left = (c['x'][slots] - radius).astype(np.int64)
+        top = (c['y'][slots] - radius).astype(np.int64)
+        return slots, left.tolist(), top.tolist(), radius.tolist()
 
-    def update(self, dt:float) -> None:
-        self.new = False
-        self._sprite.update(self._direction * self._speed * dt)
-        self.check_lifetime(dt)
+    def rects(self) -> list[tuple[str, pg.Rect]]:
+        slots, left, top, radius = self._alive()
+        ids = self._ids
+        return [(ids[slot], pg.Rect(x, y, r * 2, r * 2)) for slot, x, y, r in zip(slots, left, top, radius)]
 
-    def check_lifetime(self, dt:float) -> None:
-        self._time_alive += (dt*1000)
-        if self._time_alive >= self._lifetime:
-            self.complete = True
-            self.new = False
-        logger.debug(f'{self._time_alive=} {self._lifetime=}')
+    def dot(self, radius: int, color) -> pg.Surface:
+        key = (radius, tuple(color))
+        surface = self._dots.get(key)
+        if surface is None:
+            surface = self._dots[key] = AnimatedSprite(None, radius=radius).get_surface(color)
+        return surface
 
-    def draw(self, screen, color=(255,128,255,255)):
-        self._sprite.draw(screen, color=color)
\ No newline at end of file
+    def draw(self, screen: pg.Surface, color=(255,128,255,255), batch: list|None=None) -> None:
+        _, left, top, radius = self._alive()
+        blits = [(self.dot(r, color), (x, y)) for x, y, r in zip(left, top, radius)]
+        if batch is None:
+            screen.blits(blits, doreturn=False)
+        else:
+            batch.extend(blits)
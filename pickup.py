@@ -25,8 +25,8 @@ class Pickup:
             'complete': self.collected
         }
 
-    def draw(self, screen: pg.surface, color=(0,255,0,255)) -> None:
+    def draw(self, screen: pg.surface, color=(0,255,0,255), batch: list|None=None) -> None:
         if not self.collected:
             if self.type == 'shield':
                 color = (0,0,255,255)
-            self._sprite.draw(screen, flip=False, color=color)
+            self._sprite.draw(screen, flip=False, color=color, batch=batch)
@@ -0,0 +1,111 @@
+"""
+Per-frame phase timings for the --debug overlay
+
+The game loop calls lap(name) as it finishes each phase of a frame and
+end_frame() at the end of it. The last few seconds of frames are kept for
+the overlay (mean time per phase, frame time percentiles, entity counts),
+and every frame can also be written to a CSV file.
+"""
+import csv
+import time
+from collections import deque
+
+import pygame as pg
+
+from server.stats import percentile
+from text import get_font
+
+class FrameProfiler:
+    def __init__(self, enabled: bool=False, window: int=120, csv_path: str|None=None) -> None:
+        self.enabled = enabled
+        self.frames: deque[tuple[dict[str,float], float, dict[str,int]]] = deque(maxlen=window)  # (phases, total, counts)
+        self._phases: dict[str,float] = {}
+        self._frame_start = 0.0
+        self._last = 0.0
+        self._frame = 0
+        self._csv_file = None
+        self._csv = None
+        self._phase_columns: list[str] = []
+        self._count_columns: list[str] = []
+        if enabled and csv_path:
+            self._csv_file = open(csv_path, 'w', newline='')
+            self._csv = csv.writer(self._csv_file)
+        self._overlay: list[pg.Surface] = []
+        self._overlay_at = 0.0
+
+    def begin_frame(self) -> None:
+        if not self.enabled: return
+        self._frame_start = self._last = time.perf_counter()
+        self._phases = {}
+
+    def lap(self, name: str) -> None:
+        """
+        Time since the previous lap (or the start of the frame) goes to phase name
+        """
+        if not self.enabled: return
+        now = time.perf_counter()
+        self._phases[name] = self._phases.get(name, 0) + now - self._last
+        self._last = now
+
+    def end_frame(self, counts: dict[str,int]) -> None:
+        if not self.enabled: return
+        total = time.perf_counter() - self._frame_start
+        self.frames.append((self._phases, total, counts))
+        self._frame += 1
+        if self._csv:
+            if not self._phase_columns:
+                # The first frame fixes the columns, every phase should lap every frame
+                self._phase_columns = list(self._phases)
+                self._count_columns = list(counts)
+                self._csv.writerow(['frame', 'time'] + [f'{p}_ms' for p in self._phase_columns] + ['frame_ms']
+                                   + self._count_columns)
+            row = [self._frame, f'{time.time():.3f}']
+            row += [f'{self._phases.get(p, 0) * 1000:.3f}' for p in self._phase_columns]
+            row.append(f'{total * 1000:.3f}')
+            row += [counts.get(c, 0) for c in self._count_columns]
+            self._csv.writerow(row)
+
+    def summary(self) -> list[str]:
+        if not self.frames:
+            return []
+        phases: dict[str,float] = {}
+        for frame_phases, _, _ in self.frames:
+            for name, seconds in frame_phases.items():
+                phases[name] = phases.get(name, 0) + seconds
+        totals = [total * 1000 for _, total, _ in self.frames]
+        work = [(total - phases_.get('idle', 0)) * 1000 for phases_, total, _ in self.frames]
+        n = len(self.frames)
+        lines = [f'frame ms p50 {percentile(totals, 50):5.1f} p95 {percentile(totals, 95):5.1f} '
+                 f'p99 {percentile(totals, 99):5.1f} max {max(totals):5.1f}',
+                 f'busy  ms p50 {percentile(work, 50):5.1f} p95 {percentile(work, 95):5.1f} '
+                 f'p99 {percentile(work, 99):5.1f} max {max(work):5.1f}']
+        lines += [f'{name:12} {seconds / n * 1000:6.2f} ms' for name, seconds in phases.items()]
+        lines += [f'{name:12} {count}' for name, count in self.frames[-1][2].items()]
+        return lines
+
+    def draw(self, screen: pg.Surface, refresh: float=0.25) -> None:
+        if not self.enabled: return
+        now = time.perf_counter()
+        if now - self._overlay_at >= refresh:
+            # Text only changes a few times a second, otherwise it can't be read anyway
+            self._overlay_at = now
+            font = get_font('Courier', 18)
+            self._overlay = [font.render(line, True, (255, 255, 255)) for line in self.summary()]
+        if not self._overlay:
+            return
+        width = max(line.get_width() for line in self._overlay) + 10
+        height = sum(line.get_height() for line in self._overlay) + 10
+        background = pg.Surface((width, height), pg.SRCALPHA)
+        background.fill((0, 0, 0, 160))
+        x = screen.get_width() - width
+        screen.blit(background, (x, 0))
+        y = 5
+        for line in self._overlay:
+            screen.blit(line, (x + 5, y))
+            y += line.get_height()
+
+    def close(self) -> None:
+        if self._csv_file:
+            self._csv_file.close()
+            self._csv_file = None
+            self._csv = None
@@ -4,30 +4,43 @@ Current state of the game
 import pygame as pg
 from entity import Player, Entity, Enemy
 from sprite_sheet import SpriteSet
+from broadphase import SpatialHash
+from steering import steer_batch
+from inbox import Inbox
+from profiler import FrameProfiler
+from text import get_font, render_text
 from random import randint
 import uuid
 from network import WebSocketClient  
-import json
 import logging
 from random import choice
-from particle import Particle
+from particle import ParticleSystem
 from pickup import Pickup
+from server.delta import MAX_HISTORY
 import time
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 class Scene:
-    def __init__(self, name:str, debug: bool=False, url: str='localhost', port: int=6789, p_uuid=None) -> None:
+    def __init__(self, name:str, debug: bool=False, url: str='localhost', port: int=6789, p_uuid=None,
+                 message_budget: float=0.004, send_rate: float=20, interpolation_delay: float=0.1,
+                 profile_csv: str|None=None, room: str|None=None) -> None:
         self.uuid = uuid.UUID(p_uuid) if p_uuid else uuid.uuid4()
         logger.info(self.uuid)
-        self._ws_client: WebSocketClient = WebSocketClient(f'ws://{url}:{port}')
-        self._ws_client.set_message_handler(self.handle_message)
+        # Server messages wait here for the game loop, handle_message never runs on the network thread
+        self._inbox = Inbox()
+        self._message_budget = message_budget  # seconds per frame spent on messages, the rest waits
+        self._ws_client: WebSocketClient = WebSocketClient(f'ws://{url}:{port}', room=room)
+        self._ws_client.set_message_handler(self._inbox.put)
         self._ws_client.start()
         self._screen: pg.Surface = pg.display.set_mode((1280, 720))
         self._other_players: dict[str, Player] = {}
         self._enemies: dict[str, Enemy] = {}
-        self._particles: dict[str,Particle] ={}
+        self._particles: ParticleSystem = ParticleSystem()  # other players' shots
         self._pick_ups: dict[str,Pickup] = {}
-        self._last_pickup: float = 0
+        # Rebuilt every update, all the per-frame rect queries go through these
+        self._enemy_grid = SpatialHash()
+        self._pickup_grid = SpatialHash()
+        self._pickups_changed: bool = False  # pickups don't move, the grid is only rebuilt when they come and go
         self._sprite_list: SpriteSet = SpriteSet({
             'player-round': {
                 'file':'assets/player-rounder.png',
@@ -57,7 +70,7 @@ class Scene:
         })
         self._player: Player = Player(pg.Vector2(self._screen.get_width() / 2, self._screen.get_height() / 2),
                 {'player-round': self._sprite_list.get_sprite('player-round')}, self.uuid, name)
-        self._font: pg.font.Font = pg.font.SysFont('Ariel', 30)
+        self._font: pg.font.Font = get_font('Ariel', 30)
         self._score: int = 0
         self._score_additional: int = 0
         self._leader_board: dict[str:dict[str:str|int]] = {}
@@ -65,45 +78,56 @@ class Scene:
         self._last_start: int = 0
         self._name: str = name
         self._current_ticks: int = 0
+        self._snapshots: dict[int, dict[str, dict]] = {}  # world state by server sequence number
+        self._snapshot_seq: int|None = None  # latest snapshot applied, acknowledged to the server
+        # Updates go to the server send_rate times a second whatever the frame rate,
+        # events are batched up until then and entities only go when they've changed
+        self._send_interval: float = 1000 / send_rate
+        self._last_send: int = 0
+        self._outgoing: dict = {}  # events (killed, particles, pickups) and score since the last send
+        self._sent_entities: dict[str, dict] = {}  # entity state the server last got from us
+        # Remote entities are drawn this many seconds in the past, between the snapshots either side
+        self._interpolation_delay: float = interpolation_delay
+        # Phase timings for the debug overlay, does nothing unless debug is on
+        self.profiler = FrameProfiler(debug, csv_path=profile_csv)
 
     def update(self, dt: float) -> None:
         self._current_ticks = pg.time.get_ticks()
+        self.process_messages()
+        self.interpolate_remote(time.time() - self._interpolation_delay)
+        self.profiler.lap('messages')
         payload = {'uuid':str(self.uuid), 'name': self._name, 'entities':{}, 'time': time.time()}
         logger.debug(f'update: {dt=}')
         enemies = {e:self._enemies[e] for e in self._enemies if self._enemies[e].is_alive}
         enemies_rect = {e:self._enemies[e].get_rect() for e in enemies}
+        self._enemy_grid.rebuild(enemies_rect)
 
         self.player_attack(enemies, dt)
+        self.profiler.lap('attack')
 
         killed = {}
         attacks = self._player.attack_particles
-        for ptcl_uuid, particle in attacks.items():
-            collides = particle.get_rect().collidedict(enemies_rect, values=True)
+        for ptcl_uuid, rect in attacks.rects():
+            collides = self._enemy_grid.collide_first(rect)
             if collides:
                 enemies[collides[0]].is_alive = False
                 enemies[collides[0]].target = None
                 self._score_additional += 100
-                particle.complete = True
+                attacks.complete(ptcl_uuid)
                 logger.debug(f'{collides[0]=} {enemies[collides[0]].is_alive=}')
                 if enemies[collides[0]].target != self.uuid:
                     killed[collides[0]] = self._current_ticks
 
-        new_particles = {p:attacks[p].serialize() for p in attacks if attacks[p].new}
+        new_particles = attacks.new_particles()
         if new_particles:
             payload['particles'] = new_particles
+        self.profiler.lap('particles')
 
-        if self._current_ticks - self._last_pickup >= 5000 and self._player.is_alive:
-            self._last_pickup = self._current_ticks
-            pickup_uuid = str(uuid.uuid4())
-            pwrup = choice(['health', 'shield'])
-            #right now only health is implements
-            pwrup = 'health'
-            self._pick_ups[pickup_uuid] = Pickup(pg.Vector2(randint(0,1264), randint(0,704)),
-                                                {pwrup: self._sprite_list.get_sprite(pwrup)})
-            payload['pickups'] = {pickup_uuid: self._pick_ups[pickup_uuid].serialize()}
-        
-        pickup_rect = {p:self._pick_ups[p].get_rect() for p in self._pick_ups}
-        collected = self._player.get_rect().collidedictall(pickup_rect, values=True)
+        # The server spawns and expires pickups, we only tell it which ones we collected
+        if self._pickups_changed:
+            self._pickups_changed = False
+            self._pickup_grid.rebuild({p:self._pick_ups[p].get_rect() for p in self._pick_ups})
+        collected = self._pickup_grid.collide(self._player.get_rect())
         if collected:
             collected = [k[0] for k in collected]
             for k in collected:
@@ -114,19 +138,17 @@ class Scene:
                     self._player.heal()
                 elif self._pick_ups[k].type == 'shield':
                     pass
+                self.remove_pickup(k)
+        self.profiler.lap('pickups')
         
         # update animation for remote players
         [self._other_players[e].update_animation() for e in self._other_players ]
-        [self._particles[p].update(dt) for p in self._particles]
-        for p in [p for p in self._particles if self._particles[p].complete]:
-            if self._particles[p].complete:
-                del self._particles[p]
+        self._particles.update(dt)
 
         if not self._player.is_alive:
             keys = pg.key.get_pressed()
             if keys[pg.K_SPACE]:
                 self._score = 0
-                self._last_pickup = self._current_ticks
                 self._last_start = self._current_ticks
                 self._player.respawn(pg.Vector2(self._screen.get_width() / 2, self._screen.get_height() / 2),
                 {'player-round': self._sprite_list.get_sprite('player-round')})
@@ -135,10 +157,13 @@ class Scene:
             payload['score'] = self._score + self._score_additional
             self._player.update(dt, self._screen.get_rect())
         was_alive = self._player.is_alive
+        self.profiler.lap('movement')
         if enemies_rect: 
             self.collision_detection(enemies, enemies_rect)
-            [enemies[e].move_to_avoiding(self._player.get_location(), enemies_rect, dt) for e in enemies if enemies[e].target == self.uuid]
+            steer_batch([enemies[e] for e in enemies if enemies[e].target == self.uuid],
+                        self._player.get_location(), enemies_rect, dt)
             # [enemies[e].move_to(self._player.get_location(), dt) for e in enemies if enemies[e].target == self.uuid]
+        self.profiler.lap('avoidance')
             
         if not self._player.is_alive:
             for e in enemies: 
@@ -152,25 +177,54 @@ class Scene:
 
         if killed:
             payload['killed'] = killed
-        payload['entities'] = {e: enemies[e].serialize() for e in enemies if enemies[e].target == self.uuid}
+        for key, value in payload.items():
+            if key in ('killed', 'particles', 'pickups'):
+                self._outgoing.setdefault(key, {}).update(value)
+            elif key == 'score':
+                self._outgoing[key] = value
+        if self._current_ticks - self._last_send >= self._send_interval:
+            self._last_send = self._current_ticks
+            self.send_update()
+        self.profiler.lap('send')
+
+    def send_update(self) -> bool:
+        """
+        Send the batched events plus the player and our enemies that changed
+        since the last send. Events are kept for the next try if it fails.
+        """
+        if self._ws_client.needs_handshake:
+            # New connection, the server has none of our state and sends us its pickups again
+            self._sent_entities.clear()
+            for p_uuid in list(self._pick_ups):
+                self.remove_pickup(p_uuid)
+        entities = {e: enemy.serialize() for e, enemy in self._enemies.items()
+                    if enemy.is_alive and enemy.target == self.uuid}
         # add player to payload
-        payload['entities'][str(self._player.uuid)] = self._player.serialize()
-        
-        if self._ws_client.running:
+        entities[str(self._player.uuid)] = self._player.serialize()
+        payload = {'uuid':str(self.uuid), 'name': self._name, 'time': time.time(), **self._outgoing,
+                   'entities': {e: state for e, state in entities.items() if self._sent_entities.get(e) != state}}
+        if self._snapshot_seq is not None:
+            payload['ack'] = self._snapshot_seq
+
+        if self._ws_client.running and self._ws_client.send(payload):
             # logger.info(f'\n\n{json.dumps(payload)=}\n\n')
-            self._ws_client.send(payload)
+            self._sent_entities = entities
+            self._outgoing = {}
+            return True
+        return False
 
     def player_attack(self, enemies, dt):
         closest = None
         if enemies:
-            closest = min([e for e in enemies], \
-                            key=lambda e: self._player.get_location().distance_to(enemies[e].get_location()))
+            location = self._player.get_rect().center
+            nearest = self._enemy_grid.nearest(location[0], location[1], k=1)
+            closest = nearest[0][0] if nearest else None
         logger.debug(f'{closest=}')
         if closest:
             self._player.attack(enemies[closest].get_location(), dt, self._current_ticks)
 
     def collision_detection(self, enemies:dict[str, Enemy], enemies_rect:dict[str, pg.Rect]):
-        collision_list = self._player.get_rect().collidedictall(enemies_rect, values=True)
+        collision_list = self._enemy_grid.collide(self._player.get_rect())
         collision_list = [k[0] for k in collision_list]
         for key in collision_list:
             if key in enemies and enemies[key].check_collides(self._player):
@@ -181,17 +235,28 @@ class Scene:
         logger.info(f'check_if_player_alive: {self._player.is_alive=}')
         return self._player.is_alive
 
-    def update_other_players(self, r_uuid_text, entity):
+    def interpolate_remote(self, render_time: float) -> None:
+        for player in self._other_players.values():
+            if player.is_alive:
+                player.interpolate(render_time)
+        for enemy in self._enemies.values():
+            if enemy.is_alive and enemy.target != self.uuid:
+                enemy.interpolate(render_time)
+
+    def update_other_players(self, r_uuid_text, entity, changes=None, timestamp=None):
         logger.debug(f'{r_uuid_text=} {entity["is_alive"]=}')
         try:
             if r_uuid_text in self._other_players:
-                self._other_players[r_uuid_text].net_update(entity)
+                self._other_players[r_uuid_text].net_update(entity if changes is None else changes, timestamp)
             else:
                 self._other_players[r_uuid_text] = Entity.from_dict(entity, self._sprite_list, uuid.UUID(r_uuid_text))
+                if timestamp is not None:
+                    self._other_players[r_uuid_text].add_position(timestamp, entity['location']['x'],
+                                                                  entity['location']['y'])
         except Exception as e:
             logger.error(f'update_other_players:add:{e=} : {r_uuid_text=} {entity=}')
 
-    def update_enemy(self, r_uuid_text, entity):
+    def update_enemy(self, r_uuid_text, entity, changes=None, timestamp=None):
         if entity['is_alive']:
             r_uuid = uuid.UUID(r_uuid_text)
             try:
@@ -199,19 +264,100 @@ class Scene:
                     if self._enemies[r_uuid_text].target == self.uuid:
                         self._enemies[r_uuid_text].is_alive = entity['is_alive']
                     else:
-                        self._enemies[r_uuid_text].net_update(entity)
+                        self._enemies[r_uuid_text].net_update(entity if changes is None else changes, timestamp)
                 else:
                     enemy = Enemy.from_dict(entity, self._sprite_list, r_uuid)
+                    if timestamp is not None:
+                        enemy.add_position(timestamp, entity['location']['x'], entity['location']['y'])
                     self._enemies[r_uuid_text] = enemy
             except Exception as e:
                 logger.error(f'update_enemy:{e=} : {r_uuid_text=} {r_uuid=} {entity=}')
 
+    def despawn_entity(self, r_uuid_text):
+        if r_uuid_text in self._enemies:
+            if self._enemies[r_uuid_text].target != self.uuid:
+                self._enemies[r_uuid_text].is_alive = False
+                self._enemies[r_uuid_text].target = None
+        elif r_uuid_text in self._other_players:
+            self._other_players[r_uuid_text].is_alive = False
+
+    def apply_snapshot(self, data:dict):
+        """
+        Rebuild the world state for data['seq'] from the acknowledged baseline
+        plus the delta, then apply whatever changed since the last snapshot
+        """
+        seq, baseline = data['seq'], data.get('baseline')
+        previous = self._snapshots.get(self._snapshot_seq, {})
+        if self._snapshot_seq is not None and seq <= self._snapshot_seq:
+            if baseline is not None:
+                return
+            # Only a new server counts again from lower down (restarted, or restored from an older
+            # snapshot). Start over from its full snapshot, diffed against what we have now.
+            logger.info(f'apply_snapshot: Server restarted its sequence at {seq=}, was {self._snapshot_seq}')
+            self._snapshots = {}
+        if baseline is None:
+            base = {}
+        elif baseline in self._snapshots:
+            base = self._snapshots[baseline]
+        else:
+            logger.error(f'apply_snapshot: Missing baseline {baseline} for {seq=}')
+            return
+        snapshot = dict(base)
+        for r_uuid, fields in data.get('entities', {}).items():
+            snapshot[r_uuid] = {**base[r_uuid], **fields} if r_uuid in base else fields
+        for r_uuid in data.get('despawned', []):
+            snapshot.pop(r_uuid, None)
+
+        # When the server took the snapshot, on our clock
+        timestamp = data['time'] - data['offset'] if 'time' in data and 'offset' in data else None
+        for r_uuid, entity in snapshot.items():
+            if r_uuid == str(self.uuid):
+                continue
+            prev = previous.get(r_uuid)
+            if prev is entity:
+                changes = {}
+            else:
+                changes = entity if prev is None else {k: v for k, v in entity.items() if prev.get(k) != v}
+            if changes:
+                if entity['type'] == 'player': self.update_other_players(r_uuid, entity, changes, timestamp)
+                elif entity['type'] == 'enemy': self.update_enemy(r_uuid, entity, changes, timestamp)
+                else: logger.error(f"could not process: {r_uuid=} {entity=}")
+            if timestamp is not None and 'location' not in changes and entity.get('is_alive'):
+                # Deltas leave out what didn't move, it still needs a sample at this time
+                self.hold_position(r_uuid, timestamp)
+        for r_uuid in previous:
+            if r_uuid not in snapshot:
+                self.despawn_entity(r_uuid)
+
+        self._snapshots[seq] = snapshot
+        self._snapshot_seq = seq
+        # The server never deltas against anything older than this delta's baseline
+        # again, or than it keeps. A full snapshot doesn't say anything: deltas against
+        # what we acked before it can still be on their way.
+        oldest = seq - MAX_HISTORY if baseline is None else max(baseline, seq - MAX_HISTORY)
+        for s in [s for s in self._snapshots if s < oldest]:
+            del self._snapshots[s]
+
+    def hold_position(self, r_uuid_text, timestamp):
+        if r_uuid_text in self._other_players:
+            self._other_players[r_uuid_text].hold_position(timestamp)
+        elif r_uuid_text in self._enemies and self._enemies[r_uuid_text].target != self.uuid:
+            self._enemies[r_uuid_text].hold_position(timestamp)
+
     def update_pickup(self, pickup:dict[str,dict[str,str]]):
-        logger.info(f'update_pickup: {pickup=}')
+        logger.debug(f'update_pickup: {pickup=}')
         for k,v in pickup.items():
+            if v['complete']:
+                self.remove_pickup(k)
+                continue
             self._pick_ups[k] = Pickup(pg.Vector2(v['x'],v['y']),
                                                 {v['type']: self._sprite_list.get_sprite(v['type'])}
                                                 )
+            self._pickups_changed = True
+
+    def remove_pickup(self, p_uuid: str):
+        if self._pick_ups.pop(p_uuid, None) is not None:
+            self._pickups_changed = True
     def spawn_enemy(self, r_uuid, entity):
         logger.debug(f'spawn_enemy: Respawning {r_uuid}')
         location = pg.Vector2(choice([randint(0, 128), randint(1152, 1280)]),\
@@ -221,17 +367,30 @@ class Scene:
         else:
             self._enemies[r_uuid] = Enemy.from_dict(entity, self._sprite_list, r_uuid)
 
-    def handle_message(self, message):
-        # Handle received message from the server
-        logger.debug(f'handle_message: Received message: {type(message)=} {message=}')
-        logger.debug(f'handle_message: Received {len(message.encode("utf-8"))} bytes')
-        data:dict[str:dict[str,object]] = json.loads(message)
-        if 'entities' in data.keys():
-            for r_uuid, remote_entity in data['entities'].items():
-                if r_uuid != str(self.uuid):
-                    if remote_entity['type'] == 'player': self.update_other_players(r_uuid, remote_entity)
-                    elif remote_entity['type'] == 'enemy': self.update_enemy(r_uuid, remote_entity)
-                    else: logger.error(f"could not process: {r_uuid=} {remote_entity=}")
+    def process_messages(self) -> int:
+        """
+        Handle queued server messages until the frame's budget is used up,
+        whatever is left over is handled next frame. Returns how many were handled.
+        """
+        deadline = time.perf_counter() + self._message_budget
+        handled = 0
+        while True:
+            data = self._inbox.get()
+            if data is None:
+                break
+            self.handle_message(data)
+            handled += 1
+            if time.perf_counter() >= deadline:
+                break
+        if len(self._inbox):
+            logger.debug(f'process_messages: {len(self._inbox)} messages left for the next frame')
+        return handled
+
+    def handle_message(self, data:dict[str:dict[str,object]]):
+        # Handle received message from the server, already decoded by the client
+        logger.debug(f'handle_message: Received message: {data=}')
+        if 'seq' in data:
+            self.apply_snapshot(data)
         if 'spawn' in data:
             for r_uuid, entity in data['spawn'].items():
                 if entity['target'] == str(self.uuid):
@@ -247,12 +406,21 @@ class Scene:
             for p_uuid, particle in data['particles'].items():
                 particle['start_time'] -= offset
                 logger.debug(f'handle_message: {particle["start_time"]=} {self._current_ticks=}')
-                self._particles[p_uuid] = Particle.from_dict(particle, time.time())
+                self._particles.add_dict(p_uuid, particle, time.time())
             logger.debug(f'handle_message: {len(self._particles)}')
 
-        # if 'pickups' in data:
-        #     logger.info(f'handle_message: {data["pickups"]=}')
-        #     self.update_pickup(data['pickups'])
+        if 'pickups_live' in data:
+            # Every pickup the server has, anything else we have is gone. Events in the
+            # same message happened after it was taken, or are already in it.
+            live = data['pickups_live']
+            for p_uuid in [p for p in self._pick_ups if p not in live]:
+                self.remove_pickup(p_uuid)
+            self.update_pickup({p_uuid: pickup for p_uuid, pickup in live.items() if p_uuid not in self._pick_ups})
+        if 'pickups' in data:
+            self.update_pickup(data['pickups'])
+        if 'pickups_removed' in data:
+            for p_uuid in data['pickups_removed']:
+                self.remove_pickup(p_uuid)
 
         if 'remove' in data.keys():
             logger.error(f'handle_message:Received remove message: {data["remove"]}')
@@ -261,31 +429,43 @@ class Scene:
 
     def quit(self):
         self._ws_client.stop()
+        self.profiler.close()
+
+    def counts(self) -> dict[str,int]:
+        return {'enemies': sum(1 for e in self._enemies.values() if e.is_alive),
+                'players': len(self._other_players) + 1,
+                'particles': len(self._particles) + len(self._player.attack_particles),
+                'pickups': len(self._pick_ups),
+                'inbox': len(self._inbox)}
 
     def draw(self):
         self._screen.fill("forestgreen")
+        # Enemies and particles are plain sprites, collect them and blit them in one go
+        batch = []
         for enemy in self._enemies:
             if self._enemies[enemy].is_alive:
-                self._enemies[enemy].draw(self._screen)
-        for _, particle in self._particles.items():
-            particle.draw(self._screen, (41,45,41,255))
+                self._enemies[enemy].draw(self._screen, batch=batch)
+        self._particles.draw(self._screen, (41,45,41,255), batch=batch)
+        self._screen.blits(batch, doreturn=False)
         for player in self._other_players:
             logger.debug(f"{player=} {self._other_players[player].is_alive=}")
             if self._other_players[player].is_alive:
                 self._other_players[player].draw(self._screen, (255,255,0,255))
+        batch = []
         for pickup in self._pick_ups:
-            self._pick_ups[pickup].draw(self._screen)
+            self._pick_ups[pickup].draw(self._screen, batch=batch)
+        self._screen.blits(batch, doreturn=False)
 
         self.draw_scoreboard()
         if self._player.is_alive:
             self._player.draw(self._screen)
             score = self._score + self._score_additional
-            text_surface = self._font.render(f'Current Score: {score}', True, (0, 0, 0))
+            text_surface = render_text(self._font, f'Current Score: {score}', (0, 0, 0))
             self._screen.blit(text_surface, (0,0))
         else:
-            game_over = self._font.render(f'Game Over', True, (128, 0, 0))
-            score_text = self._font.render(f'Score for this run: {self._score}',True, (0,0,0))
-            retry_text = self._font.render(f'Press space to retry', True, (0,0,0))
+            game_over = render_text(self._font, f'Game Over', (128, 0, 0))
+            score_text = render_text(self._font, f'Score for this run: {self._score}', (0,0,0))
+            retry_text = render_text(self._font, f'Press space to retry', (0,0,0))
             self._screen.blit(game_over, 
                                 (self._screen.get_width()/2 - game_over.get_width()/2,
                                 self._screen.get_height()/2 - game_over.get_height() - score_text.get_height()/2))
@@ -295,13 +475,15 @@ class Scene:
             self._screen.blit(retry_text, 
                                 (self._screen.get_width()/2 - retry_text.get_width()/2,
                                 self._screen.get_height()/2 + retry_text.get_height() + score_text.get_height()/2))
+        self.profiler.draw(self._screen)
             
     def draw_scoreboard(self):
-        score_header = self._font.render(f'All Player Top Scores', True, [0,0,0])
+        score_header = render_text(self._font, f'All Player Top Scores', [0,0,0])
         score_lines = [score_header]
         line_height = score_header.get_height()
-        for p_uuid, board in self._leader_board.items():
-            line = self._font.render(f'{board["name"]}: {board["score"]}', True, [0,0,0])
+        # The server sends the top scores in rank order, whole board at a time
+        for rank, board in enumerate(self._leader_board.values(), 1):
+            line = render_text(self._font, f'{rank}. {board["name"]}: {board["score"]}', [0,0,0])
             score_lines.append(line)
         for idx, line in enumerate(score_lines):
             self._screen.blit(
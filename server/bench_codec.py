@@ -0,0 +1,74 @@
+"""
+Compare the JSON and binary codecs on representative messages
+
+    python3 bench_codec.py [-n ITERATIONS]
+
+Reports bytes per message and mean encode/decode time for each codec.
+"""
+import argparse
+import time
+import timeit
+import uuid
+from random import randint, random
+
+from codec import BINARY, JSON
+
+def make_entity(e_type: str='enemy') -> dict:
+    return {
+        'type': e_type,
+        'location': {'x': randint(0, 1280), 'y': randint(0, 720), 'width': 20, 'height': 20},
+        'velocity': {'x': random() * 400, 'y': random() * 400},
+        'sprite': 'player-round' if e_type == 'player' else None,
+        'facing_left': False,
+        'name': 'player' if e_type == 'player' else None,
+        'is_alive': True,
+        'max_velocity': 400,
+        'hp': 100,
+        'max_hp': 100,
+        'target': str(uuid.uuid4()),
+    }
+
+def make_particle() -> dict:
+    return {
+        'start_time': time.time(),
+        'origin': {'x': random() * 1280, 'y': random() * 720},
+        'direction': {'x': random(), 'y': random()},
+        'speed': 600,
+        'lifetime': 1000,
+        'type': 'particle',
+        'radius': 5.0
+    }
+
+def messages() -> dict[str, dict]:
+    full = {str(uuid.uuid4()): make_entity() for _ in range(1001)}
+    full.update({str(uuid.uuid4()): make_entity('player') for _ in range(8)})
+    delta = {e_uuid: {'location': make_entity()['location']} for e_uuid in list(full)[:50]}
+    return {
+        'full snapshot (1009 entities)': {'seq': 1, 'baseline': None, 'entities': full, 'offset': 0.01},
+        'delta (50 moved)': {'seq': 2, 'baseline': 1, 'entities': delta, 'offset': 0.01},
+        'client update (10 entities)': {
+            'uuid': str(uuid.uuid4()), 'name': 'player', 'time': time.time(), 'score': 1234, 'ack': 2,
+            'entities': {str(uuid.uuid4()): make_entity() for _ in range(10)}
+        },
+        'particles (10)': {'particles': {str(uuid.uuid4()): make_particle() for _ in range(10)}, 'offset': 0.01},
+        'killed (10)': {'killed': {str(uuid.uuid4()): randint(0, 100000) for _ in range(10)}, 'offset': 0.01},
+        'pickups (10)': {'pickups': {str(uuid.uuid4()): {'x': randint(0, 1264), 'y': randint(0, 704),
+                                                          'type': 'health', 'complete': False} for _ in range(10)}},
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--iterations", help="Timing iterations per message", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f'{"message":32} {"codec":6} {"bytes":>8} {"encode us":>10} {"decode us":>10}')
+    for name, message in messages().items():
+        for codec in (JSON, BINARY):
+            frame = codec.encode(message)
+            encode_time = timeit.timeit(lambda: codec.encode(message), number=args.iterations) / args.iterations
+            decode_time = timeit.timeit(lambda: codec.decode(frame), number=args.iterations) / args.iterations
+            size = len(frame.encode('utf-8')) if isinstance(frame, str) else len(frame)
+            print(f'{name:32} {codec.name:6} {size:8d} {encode_time * 1e6:10.1f} {decode_time * 1e6:10.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Append-only log of everything the server receives, for replaying later
+
+Each record is a fixed header (kind, receive time, id and payload lengths)
+followed by the client id and the raw frame as it came off the socket, so
+nothing is decoded or re-encoded on the way in. Besides messages the log
+has connects (with the handshake), disconnects and the server's ticks, so
+a replay hands messages to handle_message in the same batches.
+
+The log is rotated like logging's RotatingFileHandler: capture.log becomes
+capture.log.1 and so on, keeping backups files. Every file starts with a
+START record and has a state snapshot next to it (capture.log.npz) taken
+at that point, so any one of them can be replayed on its own.
+"""
+import json
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+MAGIC = b'GDCAP1'
+
+START = 0  # payload is a JSON header from the server (random seed, connected clients)
+CONNECT = 1  # payload is the client's handshake
+MESSAGE = 2
+DISCONNECT = 3
+TICK = 4
+BINARY = 0x80  # set on the kind when the payload was a binary frame
+
+_RECORD = struct.Struct('<BdHI')  # kind, receive time, client id length, payload length
+
+def state_path(path: str|Path) -> str:
+    """
+    Where the state snapshot for a capture file goes
+    """
+    return f'{path}.npz'
+
+class CaptureLog:
+    def __init__(self, path: str, max_bytes: int=64 * 1024 * 1024, backups: int=5,
+                 on_segment: Callable[[str], dict]|None=None) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.on_segment = on_segment  # writes the state for a new file, returns the START header
+        self.records = 0
+        self._file = None
+        self._size = 0
+        self._last_flush: float = 0
+
+    def open(self, now: float) -> None:
+        self._file = open(self.path, 'wb')
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+        header = self.on_segment(state_path(self.path)) if self.on_segment else {}
+        self.write(START, now, '', json.dumps(header))
+        logger.info(f'open: Capturing inbound messages to {self.path}')
+
+    def write(self, kind: int, now: float, client_id: str, payload: str|bytes=b'') -> None:
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif kind in (CONNECT, MESSAGE):
+            kind |= BINARY
+        client = client_id.encode('utf-8')
+        self._file.write(_RECORD.pack(kind, now, len(client), len(payload)))
+        self._file.write(client)
+        self._file.write(payload)
+        self._size += _RECORD.size + len(client) + len(payload)
+        self.records += 1
+
+    def connect(self, client_id: str, now: float, handshake: str|bytes) -> None:
+        self.write(CONNECT, now, client_id, handshake)
+
+    def message(self, client_id: str, now: float, message: str|bytes) -> None:
+        self.write(MESSAGE, now, client_id, message)
+
+    def disconnect(self, client_id: str, now: float) -> None:
+        self.write(DISCONNECT, now, client_id)
+
+    def tick(self, now: float) -> None:
+        self.write(TICK, now, '')
+        if now - self._last_flush >= 1:
+            self._last_flush = now
+            self._file.flush()
+
+    def maybe_rotate(self, now: float) -> None:
+        """
+        Call only when everything received has been handled, a new file's
+        state snapshot has to cover every record in the files before it
+        """
+        if self._size >= self.max_bytes:
+            self.rotate(now)
+
+    def rotate(self, now: float) -> None:
+        self.close()
+        for suffix in ('', '.npz'):
+            for i in range(self.backups - 1, 0, -1):
+                if Path(f'{self.path}.{i}{suffix}').exists():
+                    os.replace(f'{self.path}.{i}{suffix}', f'{self.path}.{i + 1}{suffix}')
+            if self.backups and Path(f'{self.path}{suffix}').exists():
+                os.replace(f'{self.path}{suffix}', f'{self.path}.1{suffix}')
+        self.open(now)
+
+    def flush(self) -> None:
+        if self._file:
+            self._file.flush()
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def read_capture(path: str) -> Iterator[tuple[int, float, str, str|bytes]]:
+    """
+    (kind, receive time, client id, payload) for every record in a capture
+    file, payloads come back as they were received, text or binary
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return  # end of file, or a record cut short by a crash
+            kind, now, client_length, payload_length = _RECORD.unpack(header)
+            client_id = f.read(client_length).decode('utf-8')
+            payload = f.read(payload_length)
+            if len(payload) < payload_length:
+                return
+            if not kind & BINARY:
+                payload = payload.decode('utf-8')
+            yield kind & ~BINARY, now, client_id, payload
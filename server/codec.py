@@ -0,0 +1,360 @@
+"""
+Wire formats for messages between the clients and the server
+
+Both codecs turn the same message dicts into frames and back. JsonCodec is
+the original text format and is always available as the fallback.
+BinaryCodec packs the hot sections (entities, spawn, despawned, particles,
+killed, pickups and the numeric header fields) into fixed layout records
+keyed by 16 byte UUIDs, anything else rides along as a small JSON blob.
+
+Frames are self describing (text frames are JSON, binary frames start with
+MAGIC), so either side can always decode what it receives, the handshake
+only decides what the server sends.
+"""
+import json
+import logging
+import struct
+import uuid
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+MAGIC = b'GD'
+PROTOCOL_VERSION = 1
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, message: dict) -> str:
+        return json.dumps(message)
+
+    def decode(self, frame: str, sizes: dict[str, int]|None=None) -> dict:
+        message = json.loads(frame)
+        if sizes is not None and isinstance(message, dict):
+            for key, value in message.items():
+                if isinstance(value, dict):
+                    sizes[key] = len(json.dumps(value))
+        return message
+
+    def has_section(self, key: str) -> bool:
+        return True
+
+    def record(self, key: str, r_uuid: str, value) -> str:
+        return f'{json.dumps(r_uuid)}: {json.dumps(value)}'
+
+    def assemble(self, fields: dict, sections: dict[str, list[str]]) -> str:
+        """
+        Build a frame from plain fields plus keyed sections made of records
+        that were encoded earlier, possibly once for many clients
+        """
+        parts = [f'{json.dumps(key)}: {json.dumps(value)}' for key, value in fields.items()]
+        parts.extend(f'{json.dumps(key)}: {{{", ".join(records)}}}' for key, records in sections.items())
+        return '{' + ', '.join(parts) + '}'
+
+_HEADER = struct.Struct('<2sBB')  # magic, version, number of sections
+_SECTION = struct.Struct('<BI')  # section tag, number of records / length
+_NO_UUID = bytes(16)
+_ENTITY_TYPES = ('entity', 'enemy', 'player')
+
+# The same few thousand ids go over the wire every tick, parsing them is most of the cost
+@lru_cache(maxsize=16384)
+def _uuid_bytes(value: str) -> bytes:
+    return uuid.UUID(value).bytes
+
+@lru_cache(maxsize=16384)
+def _uuid_str(raw: bytes) -> str:
+    return str(uuid.UUID(bytes=raw))
+
+def _pack_str(value: str|None) -> bytes:
+    if value is None:
+        return b'\xff'
+    encoded = value.encode('utf-8')
+    if len(encoded) > 254:
+        # Cutting it short could split a character, the message goes as JSON instead
+        raise ValueError(f'_pack_str: {len(encoded)} bytes is too long for a binary string')
+    return bytes((len(encoded),)) + encoded
+
+def _unpack_str(buf: bytes, pos: int) -> tuple[str|None, int]:
+    length = buf[pos]
+    if length == 0xff:
+        return None, pos + 1
+    return buf[pos + 1:pos + 1 + length].decode('utf-8'), pos + 1 + length
+
+def _pack_uuid(value: str|None) -> bytes:
+    if value is None:
+        return _NO_UUID
+    return _uuid_bytes(value)
+
+def _unpack_uuid(buf: bytes, pos: int) -> tuple[str|None, int]:
+    raw = buf[pos:pos + 16]
+    return (None if raw == _NO_UUID else _uuid_str(raw)), pos + 16
+
+def _scalar(fmt: str):
+    packer = struct.Struct('<' + fmt)
+    size = packer.size
+    unpack_from = packer.unpack_from
+    def unpack(buf: bytes, pos: int) -> tuple[object, int]:
+        return unpack_from(buf, pos)[0], pos + size
+    return packer.pack, unpack
+
+_LOCATION = struct.Struct('<ffHH')
+_XY = struct.Struct('<ff')
+
+def _pack_location(value: dict) -> bytes:
+    return _LOCATION.pack(value['x'], value['y'], value.get('width', 0), value.get('height', 0))
+
+def _unpack_location(buf: bytes, pos: int) -> tuple[dict, int]:
+    x, y, width, height = _LOCATION.unpack_from(buf, pos)
+    return {'x': x, 'y': y, 'width': width, 'height': height}, pos + _LOCATION.size
+
+def _pack_xy(value: dict) -> bytes:
+    return _XY.pack(value['x'], value['y'])
+
+def _unpack_xy(buf: bytes, pos: int) -> tuple[dict, int]:
+    x, y = _XY.unpack_from(buf, pos)
+    return {'x': x, 'y': y}, pos + _XY.size
+
+def _pack_type(value: str) -> bytes:
+    return bytes((_ENTITY_TYPES.index(value),))
+
+def _unpack_type(buf: bytes, pos: int) -> tuple[str, int]:
+    return _ENTITY_TYPES[buf[pos]], pos + 1
+
+# Entity fields in bit order, records carry a bitmask of the fields present
+# so delta updates only pay for what changed
+_ENTITY_FIELDS = (
+    ('type', _pack_type, _unpack_type),
+    ('location', _pack_location, _unpack_location),
+    ('velocity', _pack_xy, _unpack_xy),
+    ('sprite', _pack_str, _unpack_str),
+    ('facing_left', *_scalar('?')),
+    ('name', _pack_str, _unpack_str),
+    ('is_alive', *_scalar('?')),
+    ('max_velocity', *_scalar('f')),
+    ('hp', *_scalar('f')),
+    ('max_hp', *_scalar('f')),
+    ('target', _pack_uuid, _unpack_uuid),
+    ('damage', *_scalar('f')),
+)
+_ENTITY_KEYS = {key: (1 << bit, pack) for bit, (key, pack, _) in enumerate(_ENTITY_FIELDS)}
+_ENTITY_UNPACK = tuple((1 << bit, key, unpack) for bit, (key, _, unpack) in enumerate(_ENTITY_FIELDS))
+_EXTRA_BIT = 15
+_U16 = struct.Struct('<H')
+
+def _pack_entity(e_uuid: str, entity: dict) -> bytes:
+    mask = 0
+    parts = {}
+    extra = {}
+    for key, value in entity.items():
+        field = _ENTITY_KEYS.get(key)
+        if field is None or (key == 'type' and value not in _ENTITY_TYPES):
+            extra[key] = value
+        else:
+            mask |= field[0]
+            parts[field[0]] = field[1](value)
+    # Fields have to go out in bit order whatever order the dict is in
+    packed = b''.join(parts[bit] for bit in sorted(parts))
+    if extra:
+        mask |= 1 << _EXTRA_BIT
+        encoded = json.dumps(extra).encode('utf-8')
+        packed += _U16.pack(len(encoded)) + encoded
+    return _uuid_bytes(e_uuid) + _U16.pack(mask) + packed
+
+def _unpack_entity(buf: bytes, pos: int) -> tuple[str, dict, int]:
+    e_uuid = _uuid_str(buf[pos:pos + 16])
+    (mask,) = _U16.unpack_from(buf, pos + 16)
+    pos += 18
+    entity = {}
+    for bit, key, unpack in _ENTITY_UNPACK:
+        if mask & bit:
+            entity[key], pos = unpack(buf, pos)
+    if mask & (1 << _EXTRA_BIT):
+        (length,) = _U16.unpack_from(buf, pos)
+        entity.update(json.loads(buf[pos + 2:pos + 2 + length]))
+        pos += 2 + length
+    return e_uuid, entity, pos
+
+_PARTICLE = struct.Struct('<16sdfffffff')  # id, start_time, origin, direction, speed, lifetime, radius
+
+def _pack_particle(p_uuid: str, particle: dict) -> bytes:
+    return _PARTICLE.pack(_uuid_bytes(p_uuid), particle['start_time'],
+                          particle['origin']['x'], particle['origin']['y'],
+                          particle['direction']['x'], particle['direction']['y'],
+                          particle['speed'], particle['lifetime'], particle['radius']) + _pack_str(particle['type'])
+
+def _unpack_particle(buf: bytes, pos: int) -> tuple[str, dict, int]:
+    raw, start_time, ox, oy, dx, dy, speed, lifetime, radius = _PARTICLE.unpack_from(buf, pos)
+    p_type, pos = _unpack_str(buf, pos + _PARTICLE.size)
+    return _uuid_str(raw), {
+        'start_time': start_time,
+        'origin': {'x': ox, 'y': oy},
+        'direction': {'x': dx, 'y': dy},
+        'speed': speed,
+        'lifetime': lifetime,
+        'type': p_type,
+        'radius': radius
+    }, pos
+
+_KILL = struct.Struct('<16sd')  # id, time of death
+
+def _pack_kill(e_uuid: str, when: float) -> bytes:
+    return _KILL.pack(_uuid_bytes(e_uuid), when)
+
+def _unpack_kill(buf: bytes, pos: int) -> tuple[str, float, int]:
+    raw, when = _KILL.unpack_from(buf, pos)
+    return _uuid_str(raw), when, pos + _KILL.size
+
+_PICKUP = struct.Struct('<16sff?')  # id, x, y, complete
+
+def _pack_pickup(p_uuid: str, pickup: dict) -> bytes:
+    return _PICKUP.pack(_uuid_bytes(p_uuid), pickup['x'], pickup['y'], pickup['complete']) + _pack_str(pickup['type'])
+
+def _unpack_pickup(buf: bytes, pos: int) -> tuple[str, dict, int]:
+    raw, x, y, complete = _PICKUP.unpack_from(buf, pos)
+    p_type, pos = _unpack_str(buf, pos + _PICKUP.size)
+    return _uuid_str(raw), {'x': x, 'y': y, 'type': p_type, 'complete': complete}, pos
+
+# Numeric header fields, packed with a presence mask like entity fields
+_META_FIELDS = (
+    ('seq', *_scalar('I')),
+    ('baseline', *_scalar('I')),
+    ('ack', *_scalar('I')),
+    ('offset', *_scalar('d')),
+    ('time', *_scalar('d')),
+    ('score', *_scalar('q')),
+)
+_META_KEYS = {key for key, _, _ in _META_FIELDS}
+
+# Events that cancel each other out, when two messages are merged the later one wins for an id
+OPPOSITES = {'spawn': 'killed', 'killed': 'spawn', 'pickups': 'pickups_removed', 'pickups_removed': 'pickups'}
+
+# Section tags, keyed sections hold {id: record}
+_SECTIONS = {
+    'entities': (1, _pack_entity, _unpack_entity),
+    'spawn': (2, _pack_entity, _unpack_entity),
+    'particles': (3, _pack_particle, _unpack_particle),
+    'killed': (4, _pack_kill, _unpack_kill),
+    'pickups': (5, _pack_pickup, _unpack_pickup),
+    'pickups_removed': (8, _pack_kill, _unpack_kill),
+    'pickups_live': (9, _pack_pickup, _unpack_pickup),
+}
+_TAGS = {tag: (key, unpack) for key, (tag, _, unpack) in _SECTIONS.items()}
+_DESPAWNED = 6
+_META = 7
+_EXTRA = 0xff
+
+class BinaryCodec:
+    name = 'bin1'
+
+    def has_section(self, key: str) -> bool:
+        return key in _SECTIONS
+
+    def record(self, key: str, r_uuid: str, value) -> bytes:
+        return _SECTIONS[key][1](r_uuid, value)
+
+    def assemble(self, fields: dict, sections: dict[str, list[bytes]]) -> bytes:
+        """
+        Build a frame from plain fields plus keyed sections made of records
+        that were encoded earlier, possibly once for many clients
+        """
+        packed = self._sections(fields)
+        packed.extend(_SECTION.pack(_SECTIONS[key][0], len(records)) + b''.join(records)
+                      for key, records in sections.items())
+        return _HEADER.pack(MAGIC, PROTOCOL_VERSION, len(packed)) + b''.join(packed)
+
+    def encode(self, message: dict) -> bytes:
+        sections = self._sections(message)
+        return _HEADER.pack(MAGIC, PROTOCOL_VERSION, len(sections)) + b''.join(sections)
+
+    def _sections(self, message: dict) -> list[bytes]:
+        sections = []
+        meta_mask = 0
+        meta = []
+        extra = {}
+        for key, value in message.items():
+            if key in _SECTIONS and isinstance(value, dict):
+                tag, pack, _ = _SECTIONS[key]
+                records = b''.join(pack(r_uuid, record) for r_uuid, record in value.items())
+                sections.append(_SECTION.pack(tag, len(value)) + records)
+            elif key == 'despawned':
+                sections.append(_SECTION.pack(_DESPAWNED, len(value)) + b''.join(_pack_uuid(r) for r in value))
+            elif key not in _META_KEYS or value is None:
+                extra[key] = value
+        for bit, (key, pack, _) in enumerate(_META_FIELDS):
+            value = message.get(key)
+            if value is not None:
+                meta_mask |= 1 << bit
+                meta.append(pack(value))
+        if meta_mask:
+            sections.append(_SECTION.pack(_META, meta_mask) + b''.join(meta))
+        if extra:
+            encoded = json.dumps(extra).encode('utf-8')
+            sections.append(_SECTION.pack(_EXTRA, len(encoded)) + encoded)
+        return sections
+
+    def decode(self, frame: bytes, sizes: dict[str, int]|None=None) -> dict:
+        """
+        Pass sizes to get the bytes each keyed section took up
+        """
+        magic, version, count = _HEADER.unpack_from(frame, 0)
+        if magic != MAGIC or version != PROTOCOL_VERSION:
+            raise ValueError(f'decode: Unsupported frame {magic=} {version=}')
+        message = {}
+        pos = _HEADER.size
+        for _ in range(count):
+            start = pos
+            tag, length = _SECTION.unpack_from(frame, pos)
+            pos += _SECTION.size
+            if tag in _TAGS:
+                key, unpack = _TAGS[tag]
+                records = message.setdefault(key, {})
+                for _ in range(length):
+                    r_uuid, record, pos = unpack(frame, pos)
+                    records[r_uuid] = record
+                if sizes is not None:
+                    sizes[key] = sizes.get(key, 0) + pos - start
+            elif tag == _DESPAWNED:
+                despawned = message.setdefault('despawned', [])
+                for _ in range(length):
+                    r_uuid, pos = _unpack_uuid(frame, pos)
+                    despawned.append(r_uuid)
+            elif tag == _META:
+                for bit, (key, _, unpack) in enumerate(_META_FIELDS):
+                    if length & (1 << bit):
+                        message[key], pos = unpack(frame, pos)
+            elif tag == _EXTRA:
+                message.update(json.loads(frame[pos:pos + length]))
+                pos += length
+            else:
+                raise ValueError(f'decode: Unknown section {tag=}')
+        return message
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {codec.name: codec for codec in (BINARY, JSON)}  # in order of preference
+
+def negotiate(offered: list[str]|None) -> JsonCodec|BinaryCodec:
+    """
+    Pick the first codec the client offered that we also support,
+    clients that don't offer anything get JSON
+    """
+    for name in offered or []:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
+
+def encode(message: dict, codec: JsonCodec|BinaryCodec=JSON) -> str|bytes:
+    if codec is JSON:
+        return JSON.encode(message)
+    try:
+        return codec.encode(message)
+    except (ValueError, TypeError, KeyError, struct.error) as e:
+        # Anything the binary layout can't represent (e.g. ids that aren't UUIDs) goes as JSON
+        logger.debug(f'encode: Falling back to JSON {e=}')
+        return JSON.encode(message)
+
+def decode(frame: str|bytes, sizes: dict[str, int]|None=None) -> dict:
+    if isinstance(frame, (bytes, bytearray, memoryview)):
+        return BINARY.decode(bytes(frame), sizes)
+    return JSON.decode(frame, sizes)
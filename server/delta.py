@@ -0,0 +1,76 @@
+"""
+Per-client delta compression of entity snapshots
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+MAX_HISTORY = 64  # snapshots kept per client, nothing older is ever used as a baseline
+
+def diff_views(base: dict[str,dict], current: dict[str,dict], memo: dict=None) -> tuple[dict[str,dict], list[str]]:
+    """
+    Compare two views of the world ({entity_id: state}) and return the
+    entities that are new or have changed fields, plus the ids that are gone.
+    New entities are sent in full, changed ones only with the changed fields.
+    Passing the same memo for every client in a tick hands clients with the
+    same baseline the same partial dicts, so they are only encoded once.
+    """
+    changed = {}
+    for e_uuid, state in current.items():
+        base_state = base.get(e_uuid)
+        if base_state is None:
+            changed[e_uuid] = state
+        elif base_state is not state:
+            key = (id(base_state), id(state))
+            if memo is not None and key in memo:
+                fields = memo[key]
+            else:
+                fields = {k: v for k, v in state.items() if base_state.get(k) != v}
+                if memo is not None:
+                    memo[key] = fields
+            if fields:
+                changed[e_uuid] = fields
+    removed = [e_uuid for e_uuid in base if e_uuid not in current]
+    return changed, removed
+
+class SnapshotHistory:
+    def __init__(self, max_history: int = MAX_HISTORY, seq: int = 0) -> None:
+        self.seq: int = seq  # last one sent, carried over a restart so clients keep counting up
+        self.acked: int|None = None
+        self._max_history = max_history
+        self._views: dict[int, dict[str,dict]] = {}
+
+    def acknowledge(self, seq: int) -> None:
+        if seq in self._views and (self.acked is None or seq > self.acked):
+            self.acked = seq
+            for old in [s for s in self._views if s < seq]:
+                del self._views[old]
+
+    def delta(self, view: dict[str,dict], memo: dict=None) -> dict|None:
+        """
+        Record view as the next snapshot and build the message that takes
+        the client from its last acknowledged snapshot to it. Returns None
+        if nothing changed since the last snapshot sent.
+        """
+        last = self._views.get(self.seq)
+        if last is not None and last.keys() == view.keys() and all(last[k] is v for k, v in view.items()):
+            return None
+        self.seq += 1
+        baseline = self.acked if self.acked in self._views else None
+        base = self._views[baseline] if baseline is not None else {}
+        changed, removed = diff_views(base, view, memo)
+        self._views[self.seq] = view
+        if len(self._views) > self._max_history:
+            # Client has stopped acking, start again from a full snapshot
+            logger.debug(f'delta: History full, dropping baseline {self.acked}')
+            oldest = min(self._views)
+            del self._views[oldest]
+            if oldest == self.acked:
+                self.acked = None
+        message = {'seq': self.seq, 'baseline': baseline}
+        if changed:
+            message['entities'] = changed
+        if removed:
+            message['despawned'] = removed
+        return message
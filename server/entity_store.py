@@ -0,0 +1,241 @@
+"""
+Array backed storage for the server's enemies
+
+Enemies live in NumPy columns indexed by slot, with an id <-> slot table.
+The store still behaves like the old {uuid: entity dict} mapping for the
+message handlers: reads return a dict built from the columns, which is
+cached until the slot is written again, so unchanged enemies keep handing
+out the same dict (the snapshot deltas rely on that).
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+NO_TARGET = -1
+
+# column name -> dtype, everything else an entity dict carries goes in _extras
+_COLUMNS = {
+    'x': np.float32,
+    'y': np.float32,
+    'w': np.uint16,
+    'h': np.uint16,
+    'vx': np.float32,
+    'vy': np.float32,
+    'hp': np.float32,
+    'max_hp': np.float32,
+    'max_velocity': np.float32,
+    'damage': np.float32,
+    'alive': np.bool_,
+    'facing_left': np.bool_,
+    'target': np.int32,  # index into _target_ids, NO_TARGET if none
+}
+_DEFAULTS = {'hp': 100, 'max_hp': 100, 'max_velocity': 400, 'damage': 10, 'w': 20, 'h': 20, 'target': NO_TARGET}
+_KNOWN_KEYS = ('type', 'location', 'velocity', 'hp', 'max_hp', 'max_velocity', 'damage', 'is_alive',
+               'facing_left', 'target', 'sprite')
+
+class EntityStore:
+    def __init__(self, capacity: int = 1024) -> None:
+        self._capacity = 0
+        self._size = 0
+        self.columns: dict[str, np.ndarray] = {name: np.zeros(0, dtype) for name, dtype in _COLUMNS.items()}
+        self._ids: list[str] = []
+        self._slots: dict[str, int] = {}
+        self._free: dict[int, None] = {}  # dead slots, used as an ordered set
+        self._target_ids: list[str|None] = []  # None where a target was forgotten
+        self._target_index: dict[str, int] = {}
+        self._free_targets: list[int] = []  # indexes of forgotten targets, to reuse
+        self._extras: dict[int, dict] = {}  # rarely used fields (sprite, name, ...) by slot
+        self._cache: dict[int, dict] = {}  # slot -> dict handed out for it since the last write
+        self._grow(capacity)
+
+    def _grow(self, capacity: int) -> None:
+        for name, column in self.columns.items():
+            grown = np.full(capacity, _DEFAULTS.get(name, 0), dtype=column.dtype)
+            grown[:self._capacity] = column
+            self.columns[name] = grown
+        logger.debug(f'_grow: {self._capacity} -> {capacity} slots')
+        self._capacity = capacity
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, e_uuid: str) -> bool:
+        return e_uuid in self._slots
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def keys(self):
+        return self._slots.keys()
+
+    def items(self):
+        return ((e_uuid, self._entity(slot)) for slot, e_uuid in enumerate(self._ids))
+
+    def get(self, e_uuid: str, default=None):
+        slot = self._slots.get(e_uuid)
+        return default if slot is None else self._entity(slot)
+
+    def __getitem__(self, e_uuid: str) -> dict:
+        return self._entity(self._slots[e_uuid])
+
+    def __setitem__(self, e_uuid: str, entity: dict) -> None:
+        slot = self._slots.get(e_uuid)
+        if slot is None:
+            slot = self._size
+            if slot == self._capacity:
+                self._grow(self._capacity * 2)
+            self._size += 1
+            self._ids.append(e_uuid)
+            self._slots[e_uuid] = slot
+        c = self.columns
+        location = entity['location']
+        c['x'][slot] = location['x']
+        c['y'][slot] = location['y']
+        c['w'][slot] = location.get('width', 20)
+        c['h'][slot] = location.get('height', 20)
+        c['vx'][slot] = entity['velocity']['x']
+        c['vy'][slot] = entity['velocity']['y']
+        c['hp'][slot] = entity.get('hp', 100)
+        c['max_hp'][slot] = entity.get('max_hp', 100)
+        c['max_velocity'][slot] = entity.get('max_velocity', 400)
+        c['damage'][slot] = entity.get('damage', 10)
+        c['facing_left'][slot] = entity.get('facing_left', False)
+        c['target'][slot] = self.target_index(entity.get('target'))
+        c['alive'][slot] = entity['is_alive']
+        if entity['is_alive']:
+            self._free.pop(slot, None)
+        else:
+            self._free[slot] = None
+        extras = {k: v for k, v in entity.items() if k not in _KNOWN_KEYS and v is not None}
+        if entity.get('sprite') is not None:
+            extras['sprite'] = entity['sprite']
+        if extras:
+            self._extras[slot] = extras
+        else:
+            self._extras.pop(slot, None)
+        self._cache.pop(slot, None)
+
+    def _entity(self, slot: int) -> dict:
+        entity = self._cache.get(slot)
+        if entity is not None:
+            return entity
+        c = self.columns
+        target = int(c['target'][slot])
+        entity = {
+            'type': 'enemy',
+            'location': {'x': float(c['x'][slot]), 'y': float(c['y'][slot]),
+                         'width': int(c['w'][slot]), 'height': int(c['h'][slot])},
+            'velocity': {'x': float(c['vx'][slot]), 'y': float(c['vy'][slot])},
+            'sprite': None,
+            'facing_left': bool(c['facing_left'][slot]),
+            'target': None if target == NO_TARGET else self._target_ids[target],
+            'is_alive': bool(c['alive'][slot]),
+            'hp': float(c['hp'][slot]),
+            'max_hp': float(c['max_hp'][slot]),
+            'max_velocity': float(c['max_velocity'][slot]),
+            'damage': float(c['damage'][slot]),
+        }
+        if slot in self._extras:
+            entity.update(self._extras[slot])
+        # Dead enemies are hardly ever read, don't keep dicts around for the whole pool
+        if entity['is_alive']:
+            self._cache[slot] = entity
+        return entity
+
+    def target_index(self, target: str|None) -> int:
+        # Every target comes through here: clients before Enemy.serialize sent None
+        # for enemies without a target sent str(None), which means the same
+        if target is None or target == 'None':
+            return NO_TARGET
+        index = self._target_index.get(target)
+        if index is None:
+            if self._free_targets:
+                index = self._free_targets.pop()
+                self._target_ids[index] = target
+            else:
+                index = len(self._target_ids)
+                self._target_ids.append(target)
+            self._target_index[target] = index
+        return index
+
+    def forget_target(self, target: str) -> None:
+        """
+        Drop a target that has gone (a player that left), so the table only
+        holds current ones. Enemies still pointing at it are left without one.
+        """
+        index = self._target_index.pop(target, None)
+        if index is None:
+            return
+        column = self.columns['target']
+        for slot in np.flatnonzero(column[:self._size] == index):
+            column[slot] = NO_TARGET
+            self._cache.pop(int(slot), None)
+        self._target_ids[index] = None
+        self._free_targets.append(index)
+
+    def first_free(self) -> str|None:
+        """
+        A dead enemy that can be respawned, None if the pool is used up
+        """
+        for slot in self._free:
+            return self._ids[slot]
+        return None
+
+    @property
+    def free_count(self) -> int:
+        return len(self._free)
+
+    def _select(self, mask: np.ndarray) -> list[str]:
+        ids = self._ids
+        return [ids[slot] for slot in np.flatnonzero(mask)]
+
+    def alive(self, exclude_target: str|None = None) -> list[str]:
+        mask = self.columns['alive'][:self._size].copy()
+        if exclude_target is not None and exclude_target in self._target_index:
+            mask &= self.columns['target'][:self._size] != self._target_index[exclude_target]
+        return self._select(mask)
+
+    def targeting(self, target: str) -> list[str]:
+        """
+        Alive enemies chasing target
+        """
+        index = self._target_index.get(target)
+        if index is None:
+            return []
+        size = self._size
+        return self._select(self.columns['alive'][:size] & (self.columns['target'][:size] == index))
+
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.columns.values())
+
+    def dump(self) -> tuple[dict[str, np.ndarray], dict]:
+        """
+        Copies of the used part of every column, plus the rest of the state
+        as plain data, cheap enough to take on the event loop
+        """
+        size = self._size
+        arrays = {name: column[:size].copy() for name, column in self.columns.items()}
+        state = {'ids': list(self._ids), 'target_ids': list(self._target_ids),
+                 'extras': {str(slot): extras for slot, extras in self._extras.items()}}
+        return arrays, state
+
+    @classmethod
+    def load(cls, arrays: dict[str, np.ndarray], state: dict) -> 'EntityStore':
+        ids = state['ids']
+        store = cls(max(len(ids), 1024))
+        size = len(ids)
+        for name in store.columns:
+            if name in arrays:
+                store.columns[name][:size] = arrays[name]
+        store._size = size
+        store._ids = list(ids)
+        store._slots = {e_uuid: slot for slot, e_uuid in enumerate(ids)}
+        store._free = dict.fromkeys(int(slot) for slot in np.flatnonzero(~store.columns['alive'][:size]))
+        store._target_ids = list(state['target_ids'])
+        store._target_index = {target: index for index, target in enumerate(store._target_ids) if target is not None}
+        store._free_targets = [index for index, target in enumerate(store._target_ids) if target is None]
+        store._extras = {int(slot): extras for slot, extras in state['extras'].items()}
+        return store
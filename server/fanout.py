@@ -0,0 +1,205 @@
+"""
+Outbound fan-out from the server to its clients
+
+Records shared between clients (events, unchanged entity states) are
+encoded once per codec per tick and only joined per client, the per-client
+offset is spliced in when the frame is assembled. Every client has its own
+bounded queue drained by its own writer task, so a slow client only backs
+up its own queue.
+"""
+import asyncio
+import logging
+import struct
+from collections import deque
+from typing import Callable
+
+import websockets
+
+from codec import JSON, OPPOSITES
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+DROP_OLDEST = 'drop-oldest'  # throw away the oldest queued frame's state, its events go with the next frame
+COALESCE = 'coalesce'  # fold the new frame into the last queued one, latest state wins
+POLICIES = (DROP_OLDEST, COALESCE)
+
+# Sections/fields that describe the whole state the client should have,
+# a newer one replaces an older one instead of being added to it. Anything
+# else is an event (spawn, killed, pickups, ...) and must reach the client.
+STATE_KEYS = ('seq', 'baseline', 'entities', 'despawned', 'scores', 'pickups_live')
+
+def _merge(older: dict, newer: dict) -> dict:
+    """
+    older's events then everything in newer, dict values are merged so a
+    record in both ends up with newer's value, and an older event cancelled
+    by its opposite in newer (killed then spawn) is dropped
+    """
+    merged = {key: value for key, value in older.items() if key not in STATE_KEYS}
+    for key, value in newer.items():
+        opposite = OPPOSITES.get(key)
+        if opposite in merged and isinstance(value, dict):
+            merged[opposite] = {r_uuid: v for r_uuid, v in merged[opposite].items() if r_uuid not in value}
+            if not merged[opposite]:
+                del merged[opposite]
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = {**merged[key], **value}
+        else:
+            merged[key] = value
+    return merged
+
+def _by_id(message: dict, sections: dict[str, list], key: str) -> dict:
+    return dict(zip(message[key], sections[key])) if key in sections else {}
+
+def _fold(older: tuple, newer: tuple) -> tuple:
+    """
+    One queued frame in place of two, older's state is dropped since newer's replaces it
+    """
+    old_codec, old_fields, old_sections, old_message = older
+    codec, fields, sections, new_message = newer
+    message = _merge(old_message, new_message)
+    keys = old_fields.keys() | fields.keys()
+    if old_codec is not codec or any(key in keys for key in old_sections.keys() | sections.keys()):
+        # Records encoded for another codec, or a section that is a plain field in the
+        # other frame, can't be joined: send the pair as one JSON frame instead
+        return JSON, dict(message), {}, message
+    # A section's records line up with its ids in the message, so the merged
+    # message says which records are left and in what order
+    merged_sections = {}
+    for key in [*old_sections, *(key for key in sections if key not in old_sections)]:
+        if key in message:
+            encoded = {**_by_id(old_message, old_sections, key), **_by_id(new_message, sections, key)}
+            merged_sections[key] = [encoded[r_uuid] for r_uuid in message[key]]
+    return codec, _merge(old_fields, fields), merged_sections, message
+
+class ClientChannel:
+    def __init__(self, client_id: str, websocket, codec=JSON, max_queue: int=8, policy: str=DROP_OLDEST,
+                 on_frame: Callable|None=None) -> None:
+        self.client_id = client_id
+        self.websocket = websocket
+        self.codec = codec
+        self.offset: float = 0
+        self.max_queue = max_queue
+        self.policy = policy
+        self.dropped: int = 0
+        self.coalesced: int = 0
+        self.on_frame = on_frame  # called with (fields, sections, frame) for every frame sent
+        self._queue: deque[tuple[object, dict, dict[str, list], dict]] = deque()  # (codec, fields, sections, message)
+        self._ready = asyncio.Event()
+        self._task = asyncio.get_event_loop().create_task(self._writer())
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def push(self, message: dict, fields: dict, sections: dict[str, list], codec=None) -> None:
+        """
+        Queue a frame, fields and sections are message split up and encoded for codec
+        """
+        frame = (codec or self.codec, fields, sections, message)
+        if len(self._queue) >= self.max_queue:
+            if self.policy == COALESCE:
+                self._queue[-1] = _fold(self._queue[-1], frame)
+                self.coalesced += 1
+                return
+            oldest = self._queue.popleft()
+            if any(key not in STATE_KEYS for key in oldest[3]):
+                # Only the state is out of date, its events still have to be delivered
+                if self._queue:
+                    self._queue[0] = _fold(oldest, self._queue[0])
+                else:
+                    frame = _fold(oldest, frame)
+            self.dropped += 1
+            logger.debug(f'push: {self.client_id} is behind, dropped oldest frame ({self.dropped} total)')
+        self._queue.append(frame)
+        self._ready.set()
+
+    async def _writer(self) -> None:
+        while True:
+            await self._ready.wait()
+            while self._queue:
+                codec, fields, sections, _ = self._queue.popleft()
+                fields['offset'] = self.offset
+                try:
+                    frame = codec.assemble(fields, sections)
+                    await self.websocket.send(frame)
+                    if self.on_frame is not None:
+                        self.on_frame(fields, sections, frame)
+                except asyncio.CancelledError:
+                    raise
+                except websockets.exceptions.ConnectionClosed:
+                    # A normal disconnect, drop_client removes the channel once the handler sees it
+                    logger.debug(f'_writer: {self.client_id} disconnected, dropping {len(self._queue)} queued frames')
+                    self._queue.clear()
+                    return
+                except Exception as e:
+                    logger.error(f"_writer: Error sending message to {self.client_id}: {e}")
+            self._ready.clear()
+
+    def close(self) -> None:
+        self._task.cancel()
+
+class FanOut:
+    def __init__(self, max_queue: int=8, policy: str=DROP_OLDEST, on_frame: Callable|None=None) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown backpressure policy {policy}, expected one of {POLICIES}')
+        self.max_queue = max_queue
+        self.policy = policy
+        self.on_frame = on_frame
+        self.channels: dict[str, ClientChannel] = {}
+        # (codec, key, record id, id(value)) -> (value, encoded), value is kept so its id stays unique
+        self._records: dict[tuple, tuple[object, str|bytes]] = {}
+
+    def add(self, client_id: str, websocket, codec=JSON) -> ClientChannel:
+        self.remove(client_id)
+        self.channels[client_id] = ClientChannel(client_id, websocket, codec, self.max_queue, self.policy,
+                                                 self.on_frame)
+        return self.channels[client_id]
+
+    def remove(self, client_id: str) -> None:
+        channel = self.channels.pop(client_id, None)
+        if channel is not None:
+            channel.close()
+
+    def end_tick(self) -> None:
+        self._records.clear()
+
+    def records(self, codec, key: str, mapping: dict) -> list:
+        encoded = []
+        for r_uuid, value in mapping.items():
+            cache_key = (codec.name, key, r_uuid, id(value))
+            cached = self._records.get(cache_key)
+            if cached is None:
+                cached = self._records[cache_key] = (value, codec.record(key, r_uuid, value))
+            encoded.append(cached[1])
+        return encoded
+
+    def send(self, client_id: str, message: dict) -> None:
+        """
+        Queue message for client_id. Dict sections the client's codec can
+        split into records are encoded per record and shared across clients.
+        """
+        channel = self.channels.get(client_id)
+        if channel is None:
+            return
+        fields = {}
+        sections = {}
+        try:
+            for key, value in message.items():
+                if isinstance(value, dict) and channel.codec.has_section(key):
+                    sections[key] = self.records(channel.codec, key, value)
+                else:
+                    fields[key] = value
+        except (ValueError, TypeError, KeyError, struct.error) as e:
+            # Same fallback as codec.encode
+            logger.debug(f'send: Falling back to JSON for {client_id} {e=}')
+            channel.push(message, dict(message), {}, JSON)
+            return
+        channel.push(message, fields, sections)
+
+    def broadcast(self, sender_id: str|None, message: dict) -> None:
+        for client_id in self.channels:
+            if client_id != sender_id:  # Don't send the message back to the sender
+                self.send(client_id, message)
+
+    def queue_depths(self) -> dict[str, int]:
+        return {client_id: len(channel) for client_id, channel in self.channels.items()}
@@ -0,0 +1,101 @@
+"""
+All time top-K leaderboard
+
+Best scores only go up, so once the board is full anyone below its lowest
+score can be forgotten: they have to beat that score to get on, and the
+score message that does it carries everything we need. The board is kept
+sorted and only the K entries on it are stored, whatever the number of
+players seen. Clients get the whole board, but only when it has changed
+and at most once every min_interval seconds.
+"""
+import asyncio
+import json
+import logging
+from bisect import bisect_left, insort
+from pathlib import Path
+
+from checkpoint import atomic_write
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+class Leaderboard:
+    def __init__(self, k: int=10, min_interval: float=1, path: str|None=None) -> None:
+        self.k = k
+        self.min_interval = min_interval
+        self.path = path
+        self.entries: dict[str, dict] = {}  # uuid -> {'name', 'score'}
+        self._ranking: list[tuple[int, str]] = []  # (-score, uuid), best first
+        self.changed = False  # since the last broadcast
+        self._unsaved = False
+        self._last_broadcast: float = 0
+        if path and Path(path).is_file():
+            self.load(path)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def update(self, p_uuid: str, name: str, score: int) -> bool:
+        """
+        Record a score, True if the board changed
+        """
+        entry = self.entries.get(p_uuid)
+        if entry is not None:
+            if score <= entry['score']:
+                if name == entry['name']:
+                    return False
+                entry['name'] = name
+                self.changed = self._unsaved = True
+                return True
+            del self._ranking[bisect_left(self._ranking, (-entry['score'], p_uuid))]
+        elif len(self._ranking) >= self.k and -score >= self._ranking[-1][0]:
+            return False
+        self.entries[p_uuid] = {'name': name, 'score': score}
+        insort(self._ranking, (-score, p_uuid))
+        if len(self._ranking) > self.k:
+            _, dropped = self._ranking.pop()
+            del self.entries[dropped]
+        self.changed = self._unsaved = True
+        return True
+
+    def board(self) -> dict[str, dict]:
+        """
+        The board in rank order
+        """
+        return {p_uuid: dict(self.entries[p_uuid]) for _, p_uuid in self._ranking}
+
+    def poll(self, now: float) -> dict[str, dict]|None:
+        """
+        The board if it has changed and the last one went out long enough ago
+        """
+        if not self.changed or now - self._last_broadcast < self.min_interval:
+            return None
+        self.changed = False
+        self._last_broadcast = now
+        return self.board()
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f'load: Could not load scores from {path}, starting empty: {e}')
+            return
+        for p_uuid, entry in saved.items():
+            self.update(p_uuid, entry['name'], entry['score'])
+        self._unsaved = False
+        logger.info(f'load: Loaded {len(self)} scores from {path}')
+
+    def save(self) -> None:
+        if not self.path or not self._unsaved:
+            return
+        try:
+            atomic_write(self.path, json.dumps(self.board()), sync=False)
+            self._unsaved = False
+        except OSError as e:
+            logger.error(f'save: Could not write scores to {self.path}: {e}')
+
+    async def persist(self, interval: float=30) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.save()
@@ -0,0 +1,264 @@
+"""
+Headless load generator for the game server
+
+    python3 load_test.py [-u HOST] [-p PORT] [-n CLIENTS] [-d SECONDS] [-m MOVEMENT] ...
+
+Opens CLIENTS websocket connections that talk to the server the way
+Scene.update does (handshake, player and enemy entities, particles, kills,
+pickups, score and snapshot acks) without pygame. Reports server
+throughput, broadcast latency percentiles and bytes per second per client.
+
+Broadcast latency is measured on particles: every bot's shots are stamped
+on send and looked up when another bot receives them, all in this process.
+Snapshot age compares the server's snapshot time with our clock, so only
+means something when the server runs on the same machine.
+"""
+import argparse
+import asyncio
+import logging
+import math
+import time
+import uuid
+from random import choice, random, uniform
+
+import websockets
+
+from codec import CODECS, JSON, decode, encode
+from stats import percentile
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+WIDTH, HEIGHT = 1280, 720
+MOVEMENTS = ('random', 'circle', 'line', 'idle')
+SHOT_TIMEOUT = 10  # seconds a shot is waited for, after that its echoes count as lost
+
+class Stats:
+    def __init__(self) -> None:
+        self.connected = 0
+        self.failed = 0
+        self.shots: dict[str, float] = {}  # particle uuid -> perf_counter when it was sent
+        self.reset_window()
+
+    def reset_window(self) -> None:
+        """
+        Start the throughput and latency figures again, connections are kept
+        """
+        self.started = time.perf_counter()
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.received_messages = 0
+        self.received_bytes = 0
+        self.relay_latency: list[float] = []  # seconds from one bot shooting to another seeing it
+        self.snapshot_age: list[float] = []
+
+    def report(self, clients: int, final: bool=False) -> str:
+        now = time.perf_counter()
+        elapsed = now - self.started
+        # Every bot that sees a shot measures it, so shots are only forgotten once they're old
+        self.shots = {p_uuid: sent for p_uuid, sent in self.shots.items() if now - sent < SHOT_TIMEOUT}
+        per_client = max(self.connected, 1) * elapsed
+        lines = [
+            f'{"final" if final else "progress"} after {elapsed:.1f}s: {self.connected}/{clients} connected, {self.failed} failed',
+            f'  server in : {self.sent_messages / elapsed:9.1f} msg/s {self.sent_bytes / per_client / 1024:8.2f} KiB/s per client',
+            f'  server out: {self.received_messages / elapsed:9.1f} msg/s {self.received_bytes / per_client / 1024:8.2f} KiB/s per client',
+        ]
+        for name, values in (('relay latency', self.relay_latency), ('snapshot age', self.snapshot_age)):
+            ms = [v * 1000 for v in values]
+            lines.append(f'  {name:13} ms: p50 {percentile(ms, 50):7.1f} p90 {percentile(ms, 90):7.1f} '
+                         f'p99 {percentile(ms, 99):7.1f} max {max(ms, default=math.nan):7.1f} (n={len(ms)})')
+        return '\n'.join(lines)
+
+class Bot:
+    def __init__(self, index: int, args, stats: Stats) -> None:
+        self.uuid = str(uuid.uuid4())
+        self.name = f'bot-{index}'
+        self.args = args
+        self.stats = stats
+        self.codec = JSON
+        self.x = uniform(0, WIDTH - 32)
+        self.y = uniform(0, HEIGHT - 32)
+        self.heading = uniform(0, 2 * math.pi)
+        self.phase = uniform(0, 2 * math.pi)
+        self.enemies: dict[str, dict] = {}  # enemies the server spawned to chase us, we simulate them
+        self.outgoing: dict[str, dict] = {}  # events (killed, particles, pickups) waiting for the next send
+        self.pickups: dict[str, dict] = {}  # pickups the server has spawned and nobody has collected yet
+        self.seq: int|None = None
+        self.score = 0
+        self.last_pickup = time.perf_counter()
+
+    def player(self) -> dict:
+        return {
+            'type': 'player',
+            'location': {'x': int(self.x), 'y': int(self.y), 'width': 32, 'height': 32},
+            'velocity': {'x': 0, 'y': 0},
+            'sprite': 'player-round',
+            'facing_left': False,
+            'name': self.name,
+            'is_alive': True,
+            'max_velocity': 450,
+            'hp': 100,
+            'max_hp': 100,
+        }
+
+    def move(self, dt: float) -> None:
+        speed = self.args.speed
+        movement = self.args.movement
+        if movement == 'random':
+            self.heading += uniform(-2, 2) * dt
+        elif movement == 'circle':
+            self.heading += speed / 150 * dt
+        elif movement == 'line' and not (0 < self.x < WIDTH - 32):
+            self.heading = math.pi - self.heading
+        if movement != 'idle':
+            self.x = min(max(self.x + math.cos(self.heading) * speed * dt, 0), WIDTH - 32)
+            self.y = min(max(self.y + math.sin(self.heading) * speed * dt, 0), HEIGHT - 32)
+            if self.y in (0, HEIGHT - 32) or movement == 'random' and self.x in (0, WIDTH - 32):
+                self.heading += math.pi / 2
+        for enemy in self.enemies.values():
+            location = enemy['location']
+            dx, dy = self.x - location['x'], self.y - location['y']
+            distance = math.hypot(dx, dy) or 1
+            location['x'] += dx / distance * 200 * dt
+            location['y'] += dy / distance * 200 * dt
+
+    def shoot(self) -> None:
+        p_uuid = str(uuid.uuid4())
+        angle = uniform(0, 2 * math.pi)
+        self.outgoing.setdefault('particles', {})[p_uuid] = {
+            'start_time': time.time(),
+            'origin': {'x': self.x + 16, 'y': self.y + 16},
+            'direction': {'x': math.cos(angle), 'y': math.sin(angle)},
+            'speed': 600,
+            'lifetime': 1000,
+            'type': 'particle',
+            'radius': 5,
+        }
+        self.stats.shots[p_uuid] = time.perf_counter()
+        # Every so often the shot "hits" one of the enemies chasing us
+        if self.enemies and random() < self.args.kill_chance:
+            e_uuid = choice(list(self.enemies))
+            del self.enemies[e_uuid]
+            self.outgoing.setdefault('killed', {})[e_uuid] = int(time.perf_counter() * 1000)
+            self.score += 100
+
+    def payload(self, handshake: bool=False) -> dict:
+        entities = {e_uuid: {**enemy, 'location': {k: int(v) for k, v in enemy['location'].items()}}
+                    for e_uuid, enemy in self.enemies.items()}
+        entities[self.uuid] = self.player()
+        payload = {'uuid': self.uuid, 'name': self.name, 'time': time.time(), 'entities': entities,
+                   'score': self.score, **self.outgoing}
+        self.outgoing = {}
+        if self.seq is not None:
+            payload['ack'] = self.seq
+        if handshake:
+            payload['codecs'] = [self.args.codec]
+        return payload
+
+    async def send(self, websocket, payload: dict) -> None:
+        message = encode(payload, self.codec)
+        await websocket.send(message)
+        self.stats.sent_messages += 1
+        self.stats.sent_bytes += len(message)
+
+    def receive(self, message) -> None:
+        now = time.perf_counter()
+        self.stats.received_messages += 1
+        self.stats.received_bytes += len(message)
+        data = decode(message)
+        if 'codec' in data:
+            self.codec = CODECS.get(data['codec'], JSON)
+        if 'seq' in data:
+            self.seq = data['seq']
+            if 'time' in data:
+                self.stats.snapshot_age.append(time.time() - data['time'])
+        for e_uuid, enemy in data.get('spawn', {}).items():
+            if enemy['target'] == self.uuid:
+                self.enemies[e_uuid] = {**enemy, 'location': dict(enemy['location'])}
+        for e_uuid in data.get('killed', {}):
+            self.enemies.pop(e_uuid, None)
+        if 'pickups_live' in data:
+            self.pickups = dict(data['pickups_live'])
+        self.pickups.update(data.get('pickups', {}))
+        for p_uuid in data.get('pickups_removed', {}):
+            self.pickups.pop(p_uuid, None)
+        for p_uuid in data.get('particles', {}):
+            sent = self.stats.shots.get(p_uuid)
+            if sent is not None:
+                self.stats.relay_latency.append(now - sent)
+
+    async def run(self, stop: asyncio.Event) -> None:
+        try:
+            websocket = await websockets.connect(f'ws://{self.args.url}:{self.args.port}', max_size=None)
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            logger.error(f'run: {self.name} could not connect: {e}')
+            self.stats.failed += 1
+            return
+        self.stats.connected += 1
+        receiver = asyncio.create_task(self._receiver(websocket))
+        try:
+            await self.send(websocket, self.payload(handshake=True))
+            interval = 1 / self.args.send_rate
+            last = time.perf_counter()
+            next_shot = last + 1 / self.args.fire_rate if self.args.fire_rate else math.inf
+            while not stop.is_set() and not receiver.done():
+                await asyncio.sleep(interval)
+                now = time.perf_counter()
+                self.move(now - last)
+                last = now
+                while now >= next_shot:
+                    self.shoot()
+                    next_shot += 1 / self.args.fire_rate
+                if now - self.last_pickup >= 5 and self.pickups:
+                    # Collect one, bots are as likely as each other to reach it first
+                    self.last_pickup = now
+                    p_uuid = choice(list(self.pickups))
+                    self.outgoing.setdefault('pickups', {})[p_uuid] = {**self.pickups.pop(p_uuid), 'complete': True}
+                self.score += int(interval * 1000)
+                await self.send(websocket, self.payload())
+        except websockets.exceptions.ConnectionClosed as e:
+            logger.error(f'run: {self.name} lost its connection: {e}')
+        finally:
+            self.stats.connected -= 1
+            receiver.cancel()
+            await websocket.close()
+
+    async def _receiver(self, websocket) -> None:
+        async for message in websocket:
+            self.receive(message)
+
+async def main(args) -> None:
+    stats = Stats()
+    stop = asyncio.Event()
+    bots = [Bot(i, args, stats) for i in range(args.clients)]
+    tasks = []
+    for bot in bots:
+        tasks.append(asyncio.create_task(bot.run(stop)))
+        await asyncio.sleep(args.ramp / max(args.clients, 1))
+    # Count from when everyone is connected, not while ramping up
+    stats.reset_window()
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(min(args.report, max(deadline - time.perf_counter(), 0)))
+        if time.perf_counter() < deadline:
+            print(stats.report(args.clients), flush=True)
+    print(stats.report(args.clients, final=True), flush=True)
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--url", help="Server host", default='localhost')
+    parser.add_argument("-p", "--port", help="Server port", type=int, default=8765)
+    parser.add_argument("-n", "--clients", help="Concurrent bot connections", type=int, default=10)
+    parser.add_argument("-d", "--duration", help="Seconds to measure for, after ramping up", type=float, default=30)
+    parser.add_argument("--ramp", help="Seconds to spread the connections over", type=float, default=2)
+    parser.add_argument("-s", "--send-rate", help="Updates per second each bot sends", type=float, default=20)
+    parser.add_argument("-m", "--movement", help="How bots move", choices=MOVEMENTS, default='random')
+    parser.add_argument("--speed", help="Bot speed in pixels per second", type=float, default=300)
+    parser.add_argument("-f", "--fire-rate", help="Shots per second per bot, 0 to not shoot", type=float, default=2)
+    parser.add_argument("-k", "--kill-chance", help="Chance a shot kills one of the bot's enemies", type=float, default=0.3)
+    parser.add_argument("-c", "--codec", help="Codec to ask the server for", choices=list(CODECS), default='bin1')
+    parser.add_argument("-r", "--report", help="Seconds between progress reports", type=float, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args))
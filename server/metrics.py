@@ -0,0 +1,166 @@
+"""
+Server instrumentation in Prometheus text format
+
+Counters and histograms are updated on the hot paths, gauges are read from
+callbacks when the metrics are rendered. render() output can be served over
+HTTP (serve) and/or written to a file every so often (dump).
+"""
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from math import inf
+from typing import Callable
+
+from checkpoint import atomic_write
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+PREFIX = 'gamedemo_'
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, inf)
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+def _number(value: float) -> str:
+    return '+Inf' if value == inf else repr(float(value))
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def lines(self, name: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{_number(bound)}"}} {cumulative}')
+        lines.append(f'{name}_sum {_number(self.sum)}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+class Metrics:
+    def __init__(self) -> None:
+        self._help: dict[str, tuple[str, str]] = {}  # name -> (type, help)
+        self._counters: dict[str, dict[tuple, float]] = {}  # name -> {label items: value}
+        self._histograms: dict[str, Histogram] = {}
+        self._gauges: dict[str, Callable[[], float|dict[str, float]]] = {}
+        self._gauge_labels: dict[str, str] = {}
+        self.loop_lag: float = 0  # last measured by watch_loop_lag
+
+    def counter(self, name: str, help: str) -> None:
+        self._help[name] = ('counter', help)
+        self._counters[name] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        values = self._counters[name]
+        key = tuple(labels.items())
+        values[key] = values.get(key, 0) + value
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        self._help[name] = ('histogram', help)
+        histogram = self._histograms[name] = Histogram(buckets)
+        return histogram
+
+    def gauge(self, name: str, help: str, read: Callable[[], float|dict[str, float]], label: str|None = None) -> None:
+        """
+        read returns the value, or {label value: value} when label is given
+        """
+        self._help[name] = ('gauge', help)
+        self._gauges[name] = read
+        if label:
+            self._gauge_labels[name] = label
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help) in self._help.items():
+            full = PREFIX + name
+            lines.append(f'# HELP {full} {help}')
+            lines.append(f'# TYPE {full} {kind}')
+            if kind == 'counter':
+                for key, value in self._counters[name].items():
+                    lines.append(f'{full}{_labels(dict(key))} {_number(value)}')
+            elif kind == 'histogram':
+                lines.extend(self._histograms[name].lines(full))
+            else:
+                try:
+                    value = self._gauges[name]()
+                except Exception as e:
+                    logger.error(f'render: Could not read {name}: {e}')
+                    continue
+                if name in self._gauge_labels:
+                    for label_value, v in value.items():
+                        lines.append(f'{full}{_labels({self._gauge_labels[name]: label_value})} {_number(v)}')
+                else:
+                    lines.append(f'{full} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+    async def watch_loop_lag(self, histogram: Histogram, interval: float = 0.1) -> None:
+        """
+        Sleep for interval over and over, anything past it is time the loop was busy elsewhere
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - start - interval, 0)
+            self.loop_lag = lag
+            histogram.observe(lag)
+
+    async def _http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass  # headers, not needed
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/metrics', '/'):
+                body = self.render().encode('utf-8')
+                status = '200 OK'
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                body = b'Not found\n'
+                status = '404 Not Found'
+                content_type = 'text/plain'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f'_http: {e=}')
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = 'localhost', port: int = 9108) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self._http, host, port)
+        logger.info(f'serve: Metrics on http://{host}:{port}/metrics')
+        return server
+
+    async def dump(self, path: str, interval: float = 10) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                atomic_write(path, self.render(), sync=False)
+            except OSError as e:
+                logger.error(f'dump: Could not write metrics to {path}: {e}')
@@ -0,0 +1,85 @@
+"""
+Server side pickup lifecycle
+
+The server spawns pickups, decides who collected them and expires the
+ones nobody did. Only changes go out: new pickups in a 'pickups' event,
+collected and expired ones in a 'pickups_removed' event, so neither end
+keeps pickups that are gone. Every so often the server also sends the
+whole set as 'pickups_live', which puts right a client that missed a
+change.
+"""
+import logging
+import uuid
+from random import choice, randint
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+class PickupManager:
+    def __init__(self, interval: float=5, lifetime: float=30, per_player: int=3, types: tuple[str, ...]=('health',),
+                 width: int=1264, height: int=704) -> None:
+        self.interval = interval  # seconds between spawns for each player alive
+        self.lifetime = lifetime  # seconds before an uncollected pickup is removed
+        self.per_player = per_player  # live pickups allowed for each player alive
+        self.types = types
+        self.width = width
+        self.height = height
+        self.pickups: dict[str, dict] = {}
+        # Every pickup lives as long, so spawn order is expiry order
+        self._expires: dict[str, float] = {}
+        self._last_spawn: float = 0
+        self.spawned = 0
+        self.collected = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self.pickups)
+
+    def spawn(self, now: float) -> tuple[str, dict]:
+        p_uuid = str(uuid.uuid4())
+        pickup = {'x': randint(0, self.width), 'y': randint(0, self.height), 'type': choice(self.types),
+                  'complete': False}
+        self.pickups[p_uuid] = pickup
+        self._expires[p_uuid] = now + self.lifetime
+        self.spawned += 1
+        return p_uuid, pickup
+
+    def update(self, now: float, players: int) -> tuple[dict[str, dict], dict[str, float]]:
+        """
+        Expire old pickups and spawn new ones, returns (added, removed)
+        """
+        removed = {}
+        for p_uuid, expires in self._expires.items():
+            if expires > now:
+                break
+            removed[p_uuid] = now
+        for p_uuid in removed:
+            del self._expires[p_uuid]
+            del self.pickups[p_uuid]
+        self.expired += len(removed)
+        added = {}
+        if players and len(self.pickups) < self.per_player * players and now - self._last_spawn >= self.interval / players:
+            self._last_spawn = now
+            p_uuid, pickup = self.spawn(now)
+            added[p_uuid] = pickup
+        return added, removed
+
+    def dump(self, now: float) -> dict:
+        return {'pickups': dict(self.pickups), 'remaining': [expires - now for expires in self._expires.values()]}
+
+    def load(self, state: dict, now: float) -> None:
+        """
+        Pickups from dump(), they get what was left of their lifetime when it was taken
+        """
+        self.pickups = dict(state['pickups'])
+        self._expires = {p_uuid: now + remaining for p_uuid, remaining in zip(self.pickups, state['remaining'])}
+
+    def collect(self, p_uuid: str) -> bool:
+        """
+        True if the pickup was there to collect, only the first client to ask gets it
+        """
+        if self.pickups.pop(p_uuid, None) is None:
+            return False
+        del self._expires[p_uuid]
+        self.collected += 1
+        return True
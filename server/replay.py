@@ -0,0 +1,149 @@
+"""
+Replay a capture into a WebSocketServer, without any sockets
+
+    python3 replay.py CAPTURE [CAPTURE ...] [-s SPEED] [--profile FILE]
+
+Starts a server from the state saved with the first capture file, then
+feeds it the recorded connects, messages and disconnects, calling tick()
+where the server ticked. Several files are replayed in order, oldest
+first (capture.log.2 capture.log.1 capture.log). The server's clock is
+the recorded one and its random seed is the one it had, so a replay makes
+the same decisions every time and close to the ones made live. Outbound
+frames go to stand-in sockets that only count them.
+
+SPEED 1 replays in real time, 10 ten times as fast, 0 as fast as it can.
+Reports the handle_message and broadcast time per tick, which is what the
+replay is for: run it before and after a change to see what it did.
+"""
+import argparse
+import asyncio
+import cProfile
+import json
+import logging
+import pstats
+import random
+import time
+
+import server as server_module
+from capture import CONNECT, DISCONNECT, MESSAGE, START, TICK, read_capture, state_path
+from codec import decode
+from server import WebSocketServer
+from stats import percentile
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+class ReplayClock:
+    """
+    Stands in for the time module in server.py, time() is the recorded time
+    """
+    perf_counter = staticmethod(time.perf_counter)
+
+    def __init__(self, now: float=0) -> None:
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+class NullSocket:
+    def __init__(self) -> None:
+        self.frames = 0
+        self.bytes = 0
+
+    async def send(self, frame) -> None:
+        self.frames += 1
+        self.bytes += len(frame)
+
+    async def close(self) -> None:
+        pass
+
+async def replay(paths: list[str], speed: float) -> dict:
+    clock = ReplayClock()
+    server_module.time = clock
+    server = None
+    sockets: dict[str, NullSocket] = {}
+    tick_times: list[float] = []
+    messages = 0
+    started = time.perf_counter()
+    first = None
+    for path in paths:
+        for kind, now, client_id, payload in read_capture(path):
+            clock.now = now
+            if first is None:
+                first = now
+            if speed:
+                delay = (now - first) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if kind == START:
+                header = json.loads(payload)
+                if server is None:
+                    server = WebSocketServer(tick_rate=header.get('tick_rate', 30), scores_file=None,
+                                             snapshot_file=state_path(path), restore=True)
+                    server.snapshot_file = None
+                    for c_id, client in header['clients'].items():
+                        # Already connected when the file was started
+                        sockets[c_id] = NullSocket()
+                        await server.add_client(c_id, sockets[c_id], {'uuid': c_id, 'time': now - client['offset'],
+                                                                      'codecs': [client['codec']]})
+                random.seed(header['seed'])
+            elif kind == CONNECT:
+                sockets[client_id] = NullSocket()
+                await server.add_client(client_id, sockets[client_id], decode(payload))
+            elif kind == MESSAGE:
+                messages += 1
+                server.update_queue.put_nowait((client_id, payload))
+            elif kind == DISCONNECT:
+                server.drop_client(client_id)
+            elif kind == TICK:
+                start = time.perf_counter()
+                await server.tick()
+                tick_times.append(time.perf_counter() - start)
+                # Let the fan-out writers drain into the null sockets
+                await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    return {
+        'recorded': clock.now - (first or 0),
+        'elapsed': elapsed,
+        'messages': messages,
+        'ticks': tick_times,
+        'handle': server.handle_latency if server else None,
+        'broadcast': server.broadcast_latency if server else None,
+        'frames': sum(s.frames for s in sockets.values()),
+        'bytes': sum(s.bytes for s in sockets.values()),
+    }
+
+def report(result: dict) -> str:
+    ticks = [t * 1000 for t in result['ticks']]
+    elapsed = result['elapsed']
+    lines = [
+        f'replayed {result["recorded"]:.1f}s of capture in {elapsed:.2f}s: {result["messages"]} messages, {len(ticks)} ticks',
+        f'  in : {result["messages"] / elapsed:9.1f} msg/s',
+        f'  out: {result["frames"]} frames {result["bytes"] / 1024:.1f} KiB',
+        f'  tick ms: p50 {percentile(ticks, 50):7.3f} p90 {percentile(ticks, 90):7.3f} '
+        f'p99 {percentile(ticks, 99):7.3f} max {max(ticks, default=0):7.3f}',
+    ]
+    for name in ('handle', 'broadcast'):
+        histogram = result[name]
+        if histogram and histogram.count:
+            lines.append(f'  {name:9} mean {histogram.sum / histogram.count * 1000:7.3f} ms (n={histogram.count})')
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("captures", help="Capture files, oldest first", nargs='+')
+    parser.add_argument("-s", "--speed", help="Replay speed, 1 is real time, 0 as fast as possible", type=float, default=0)
+    parser.add_argument("--profile", help="Write cProfile stats for the replay to this file", default=None)
+    parser.add_argument("-q", "--quiet", help="Only log warnings from the server", action='store_true')
+    args = parser.parse_args()
+    if args.quiet:
+        logging.getLogger().setLevel(logging.WARNING)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    result = asyncio.run(replay(args.captures, args.speed))
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    print(report(result), flush=True)
@@ -0,0 +1,191 @@
+"""
+Rooms, each one a WebSocketServer in its own worker process
+
+The front process (RoomRouter) owns the public port. It reads a client's
+handshake, picks the room it asked for or one with space in it, and relays
+the connection to that room's worker on a local port. Every room has its
+own entity pool, spawn rates and tick loop, so rooms run on separate cores
+and players in one never see the others.
+
+Rooms are started on demand, up to max_rooms, and a room whose worker died
+is started again the next time someone is sent to it.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import re
+from pathlib import Path
+
+import websockets
+
+from codec import decode
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+ROOM_NAME = re.compile(r'^[\w-]{1,32}$')
+
+def room_path(path: str, name: str) -> str:
+    return str(Path(path).with_stem(f'{Path(path).stem}-{name}'))
+
+def run_room(name: str, port: int, server_options: dict, spawn_rates: dict|None, metrics_port: int|None,
+             metrics_host: str='localhost', metrics_file: str|None=None, metrics_interval: float=10) -> None:
+    """
+    Worker process entry point, runs one room until interrupted
+    """
+    # Imported here so the router process never builds a world of its own
+    from server import WebSocketServer, update_entities
+    logging.basicConfig(level=logging.INFO, format=f'%(levelname)s:{name}:%(name)s:%(message)s', force=True)
+    # Every room has its own leaderboard, state, capture and metrics file
+    server_options = dict(server_options)
+    for option in ('scores_file', 'snapshot_file', 'capture_file'):
+        if server_options.get(option):
+            server_options[option] = room_path(server_options[option], name)
+    server = WebSocketServer(room=name, spawn_rates=spawn_rates, **server_options)
+    server.run(update_entities, host='localhost', port=port, metrics_port=metrics_port, metrics_host=metrics_host,
+               metrics_file=room_path(metrics_file, name) if metrics_file else None, metrics_interval=metrics_interval)
+
+class Room:
+    def __init__(self, name: str, port: int, metrics_port: int|None=None) -> None:
+        self.name = name
+        self.port = port
+        self.metrics_port = metrics_port
+        self.clients: set[str] = set()
+        self.process: multiprocessing.Process|None = None
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+class RoomRouter:
+    def __init__(self, max_rooms: int=4, room_size: int=8, room_port: int=8766, metrics_port: int|None=None,
+                 rooms_file: str|None=None, server_options: dict|None=None, metrics_host: str='localhost',
+                 metrics_file: str|None=None, metrics_interval: float=10) -> None:
+        self.max_rooms = max_rooms
+        self.room_size = room_size  # players before a new room is opened for the next one
+        self.room_port = room_port  # first worker port, the rest follow on from it
+        self.metrics_port = metrics_port  # same for the workers' metrics
+        self.metrics_host = metrics_host
+        self.metrics_file = metrics_file  # each room writes its own, named after it
+        self.metrics_interval = metrics_interval
+        self.server_options = server_options or {}
+        self.rooms: dict[str, Room] = {}
+        self.room_spawn_rates: dict[str, dict] = {}  # room name -> spawn rate overrides
+        if rooms_file and Path(rooms_file).is_file():
+            with open(rooms_file) as f:
+                self.room_spawn_rates = json.load(f)
+            logger.info(f'__init__: Loaded settings for rooms {list(self.room_spawn_rates)}')
+        # spawn rather than fork, the router is inside a running event loop when it starts rooms
+        self._context = multiprocessing.get_context('spawn')
+        self._next_room = 1
+
+    def start_room(self, room: Room) -> None:
+        logger.info(f'start_room: Starting room {room.name} on port {room.port}')
+        room.clients.clear()
+        room.process = self._context.Process(
+            target=run_room, name=f'room-{room.name}', daemon=True,
+            args=(room.name, room.port, self.server_options, self.room_spawn_rates.get(room.name), room.metrics_port,
+                  self.metrics_host, self.metrics_file, self.metrics_interval))
+        room.process.start()
+
+    def new_room(self, name: str|None=None) -> Room:
+        index = len(self.rooms)
+        while name is None or name in self.rooms:
+            name = f'room-{self._next_room}'
+            self._next_room += 1
+        room = self.rooms[name] = Room(name, self.room_port + index,
+                                       self.metrics_port + index if self.metrics_port else None)
+        self.start_room(room)
+        return room
+
+    def assign(self, requested: str|None=None) -> Room:
+        """
+        The room asked for if there is one or one can be opened, otherwise the
+        fullest room with space, so players end up together
+        """
+        if requested is not None and ROOM_NAME.match(str(requested)):
+            if requested in self.rooms:
+                return self.rooms[requested]
+            if len(self.rooms) < self.max_rooms:
+                return self.new_room(requested)
+            logger.warning(f'assign: No space for a new room {requested}, assigning one instead')
+        open_rooms = [room for room in self.rooms.values() if len(room) < self.room_size]
+        if open_rooms:
+            return max(open_rooms, key=len)
+        if len(self.rooms) < self.max_rooms:
+            return self.new_room()
+        return min(self.rooms.values(), key=len)
+
+    async def connect(self, room: Room, timeout: float=10):
+        """
+        Connection to the room's worker, waits for it to come up if it has just been started
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                return await websockets.connect(f'ws://localhost:{room.port}', max_size=None)
+            except OSError:
+                if loop.time() > deadline or not room.running:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def _relay(self, source, destination) -> None:
+        async for message in source:
+            await destination.send(message)
+
+    async def handler(self, websocket, path):
+        try:
+            initial_message = await websocket.recv()
+            data = decode(initial_message)
+            client_id = data.get('uuid')
+        except Exception as e:
+            logger.error(f'handler: Bad handshake, closing connection: {e}')
+            await websocket.close()
+            return
+        room = self.assign(data.get('room'))
+        if not room.running:
+            self.start_room(room)
+        try:
+            upstream = await self.connect(room)
+        except OSError as e:
+            logger.error(f'handler: Room {room.name} is not answering, closing {client_id}: {e}')
+            await websocket.close()
+            return
+        room.clients.add(client_id)
+        logger.info(f'handler: Client {client_id} in room {room.name} ({len(room)} players)')
+        try:
+            await upstream.send(initial_message)
+            relays = [asyncio.ensure_future(self._relay(websocket, upstream)),
+                      asyncio.ensure_future(self._relay(upstream, websocket))]
+            # Either side closing ends the connection for both
+            done, pending = await asyncio.wait(relays, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception() and not isinstance(task.exception(), websockets.exceptions.ConnectionClosed):
+                    logger.error(f'handler: Relay for {client_id} failed: {task.exception()}')
+        finally:
+            room.clients.discard(client_id)
+            await upstream.close()
+            await websocket.close()
+            logger.info(f'handler: Client {client_id} left room {room.name}')
+
+    def run(self, host: str='localhost', port: int=8765) -> None:
+        start_server = websockets.serve(self.handler, host, port, max_size=None)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(start_server)
+        logger.info(f'Room router started on ws://{host}:{port}, up to {self.max_rooms} rooms of {self.room_size}')
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            logger.info('Shutting down rooms...')
+        finally:
+            for room in self.rooms.values():
+                if room.running:
+                    room.process.terminate()
+                    room.process.join(5)
@@ -4,35 +4,36 @@ import json
 import logging
 from pathlib import Path
 import uuid
+import random
 from random import randint, choice
 import time
+
+from capture import CaptureLog
+from checkpoint import read_snapshot, snapshot_loop, write_snapshot
+from codec import JSON, decode, negotiate
+from delta import SnapshotHistory
+from entity_store import EntityStore
+from fanout import DROP_OLDEST, FanOut
+from leaderboard import Leaderboard
+from metrics import Metrics
+from pickups import PickupManager
+from spatial import SpatialGrid
 # Configure logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 class WebSocketServer:
-    def __init__(self):
+    def __init__(self, tick_rate: float = 30, max_queue: int = 8, backpressure: str = DROP_OLDEST,
+                 interest_radius: float|None = 1500, interest_hysteresis: float = 200, room: str|None = None,
+                 spawn_rates: dict|None = None, scores_file: str|None = 'scores.json', leaderboard_size: int = 10,
+                 leaderboard_interval: float = 1, snapshot_file: str|None = 'state.npz', snapshot_interval: float = 10,
+                 restore: bool = False, restore_grace: float = 30, capture_file: str|None = None,
+                 capture_max_bytes: int = 64 * 1024 * 1024, capture_backups: int = 5, pickup_resync: float = 10):
+        self.room = room  # name of the room this server runs, None when it's the only one
         self.connected_clients = {}
         self.messages = asyncio.Queue()  # Use an asyncio.Queue for safe access
         self.running = True
-        self.entities = {}
-        for _ in range(1001):
-            self.entities[str(uuid.uuid4())] = {
-                    'type': 'enemy',
-                    'location': {
-                        'x': choice([randint(0, 128), randint(1152, 1280)]), 
-                        'y': choice([randint(0, 128), randint(592, 720)]),
-                        'width' : 20,
-                        'height' : 20
-                    },
-                    'velocity': {'x': 0, 'y': 0},
-                    'sprite': None,
-                    'facing_left': False,
-                    'target': None,
-                    'is_alive': False,
-                    'hp': 100,
-                    'damage': 10
-                }
+        self.entities = EntityStore()  # enemies, dead ones are kept as a pool to respawn from
         self.players = {}
         # {
         #     str(uuid.uuid4()):{
@@ -51,19 +52,28 @@ class WebSocketServer:
         #         'is_alive': False
         #     }
         # }
-        self.pickups: dict[str,str|int] = {}
-        # {
-        #     str(uuid.uuid4) :{
-        #         'x': 0,
-        #         'y': 0,
-        #         'type': choice(['health', 'shield']),
-        #         'complete': False
-        #     }
-        # }
+        self.pickups = PickupManager()  # spawned, collected and expired here, clients only get the changes
+        self.pickup_resync = pickup_resync  # seconds between sending every client the whole set, 0 never
+        self.resync_pickups = False  # send it with this tick's update
+        self._pickups_synced = time.time()
         self.last_message_time = asyncio.get_event_loop().time()  # Track last message time
-        self.update_interval = 0.01  # Update interval in seconds
-        self.scores = {}
-        self.update_queue = asyncio.Queue()
+        self.tick_rate = tick_rate
+        self.update_interval = 1 / tick_rate  # Update interval in seconds
+        self.scores = {}  # connected players' current scores, for the spawn rate
+        self.leaderboard = Leaderboard(leaderboard_size, leaderboard_interval, scores_file)
+        self.update_queue = asyncio.Queue()  # (client_id, raw message) waiting for the next tick
+        self.dirty_entities: set[str] = set()  # entities/players changed since the last tick
+        self.pending_events: list[tuple[str|None, str, dict]] = []  # (sender_id, key, payload)
+        self.needs_full_update: set[str] = set()  # clients that have not had the full world yet
+        self.client_history: dict[str, SnapshotHistory] = {}  # snapshots sent to each client
+        self.metrics = Metrics()
+        self.fanout = FanOut(max_queue, backpressure, self.count_frame)  # per-client outbound queues and writers
+        # Clients only get entities within interest_radius of their player, once in view
+        # they stay until they're further than interest_radius + interest_hysteresis
+        self.grid = SpatialGrid()
+        self.interest_radius = interest_radius
+        self.interest_hysteresis = interest_hysteresis
+        self.client_interest: dict[str, set[str]] = {}
         self.kill_queue = asyncio.Queue()
         self.killed = []
         self.enemy_spawn_rate: dict[str,float] = {
@@ -78,53 +88,389 @@ class WebSocketServer:
             with open(Path("spawn_rates.json"), 'r') as f:
                 self.enemy_spawn_rate = json.load(f)
                 logger.info(f'__init__: Spawn rate file loaded {self.enemy_spawn_rate=}')
+        if spawn_rates:
+            self.enemy_spawn_rate = {**self.enemy_spawn_rate, **spawn_rates}
+            logger.info(f'__init__: Spawn rates for room {room} {self.enemy_spawn_rate=}')
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        # Carried over from a restored snapshot until each client reconnects
+        self.resume_seq: dict[str, int] = {}
+        self.spawn_multipliers: dict[str, float] = {}
+        self.restored_players: dict[str, float] = {}  # player -> time it is given up on if it hasn't reconnected
+        self.restore_grace = restore_grace
+        self.register_metrics()
+        if not (restore and snapshot_file and self.restore(snapshot_file)):
+            for _ in range(1001):
+                self.new_enemy()
+        self.capture = None  # log of everything received, for replay.py
+        if capture_file:
+            self.capture = CaptureLog(capture_file, capture_max_bytes, capture_backups, self.start_capture_segment)
+            self.capture.open(time.time())
+
+    def register_metrics(self):
+        m = self.metrics
+        m.counter('messages_total', 'Messages received (in) and sent (out), by the sections they carried')
+        m.counter('bytes_total', 'Bytes received and sent, split by section')
+        self.handle_latency = m.histogram('handle_message_seconds', 'Time spent applying one client message')
+        self.broadcast_latency = m.histogram('broadcast_seconds', 'Time spent building and queueing updates for every client')
+        self.loop_lag = m.histogram('event_loop_lag_seconds', 'How late the event loop woke a sleeping task')
+        self.capture_latency = m.histogram('snapshot_capture_seconds', 'Time the event loop spent capturing state for a snapshot')
+        m.gauge('event_loop_lag_last_seconds', 'Most recent event loop lag measurement', lambda: m.loop_lag)
+        m.gauge('connected_clients', 'Clients with an open connection',
+                lambda: sum(1 for lst in self.connected_clients.values() if lst))
+        m.gauge('alive_enemies', 'Enemies currently alive', lambda: len(self.entities) - self.entities.free_count)
+        m.gauge('free_enemies', 'Dead enemies in the pool ready to respawn', lambda: self.entities.free_count)
+        m.gauge('pickups', 'Pickups waiting to be collected', lambda: len(self.pickups))
+        m.gauge('pickups_removed', 'Pickups removed since the server started, by why',
+                lambda: {'collected': self.pickups.collected, 'expired': self.pickups.expired}, 'reason')
+        m.gauge('outbound_queue_depth', 'Frames waiting in each client\'s outbound queue', self.fanout.queue_depths, 'client')
+        m.gauge('outbound_dropped_frames', 'Frames dropped for each client that fell behind',
+                lambda: {c: channel.dropped for c, channel in self.fanout.channels.items()}, 'client')
+
+    def count_frame(self, fields: dict, sections: dict[str, list], frame: str|bytes):
+        size = len(frame)
+        for key, records in sections.items():
+            section = sum(len(record) for record in records)
+            self.metrics.inc('messages_total', direction='out', type=key)
+            self.metrics.inc('bytes_total', section, direction='out', type=key)
+            size -= section
+        for key in fields:
+            if key not in ('offset', 'time', 'baseline'):
+                self.metrics.inc('messages_total', direction='out', type='snapshot' if key == 'seq' else key)
+        self.metrics.inc('bytes_total', size, direction='out', type='other')
     
+    async def tick(self) -> bool:
+        """
+        Apply every message received since the last tick, then send each client
+        a single merged update. Returns True if anything was sent.
+        """
+        if self.capture:
+            self.capture.tick(time.time())
+        while not self.update_queue.empty():
+            client_id, message = self.update_queue.get_nowait()
+            if self.connected_clients.get(client_id):
+                try:
+                    with self.handle_latency.time():
+                        await self.handle_message(client_id, message)
+                except Exception as e:
+                    # One bad message costs its sender the connection, not everyone the tick
+                    logger.error(f'tick: Could not handle message from {client_id}, closing it: {e!r}')
+                    self.close_client(client_id)
+            self.update_queue.task_done()
+        if self.restored_players:
+            self.expire_restored_players()
+        self.update_pickups()
+        if self.pickup_resync and time.time() - self._pickups_synced >= self.pickup_resync:
+            self._pickups_synced = time.time()
+            self.resync_pickups = True
+        board = self.leaderboard.poll(time.time())
+        if board is not None:
+            self.queue_event(None, 'scores', board)
+        sent = False
+        if self.dirty_entities or self.pending_events or self.needs_full_update or self.resync_pickups:
+            with self.broadcast_latency.time():
+                await self.send_update()
+            sent = True
+        if self.capture:
+            # Everything received so far has been handled, the only safe place to start a new file
+            self.capture.maybe_rotate(time.time())
+        return sent
+
+    def start_capture_segment(self, state_file: str) -> dict:
+        """
+        Start of a capture file: the state to replay it from, and a new
+        random seed so the replay makes the same random choices we do
+        """
+        seed = random.randrange(2 ** 32)
+        random.seed(seed)
+        write_snapshot(state_file, *self.capture_state())
+        clients = {client_id: {'codec': self.fanout.channels[client_id].codec.name, 'offset': lst[1]}
+                   for client_id, lst in self.connected_clients.items() if lst and client_id in self.fanout.channels}
+        return {'seed': seed, 'tick_rate': self.tick_rate, 'clients': clients}
+
+    def capture_state(self) -> tuple[dict, dict]:
+        """
+        Everything needed to carry on after a restart, copied so it can be
+        written out while the server keeps changing
+        """
+        with self.capture_latency.time():
+            now = time.time()
+            arrays, entities = self.entities.dump()
+            seqs = {**self.resume_seq, **{c: history.seq for c, history in self.client_history.items()}}
+            multipliers = {**self.spawn_multipliers,
+                           **{c: lst[2] for c, lst in self.connected_clients.items() if lst}}
+            state = {
+                'time': now,
+                'entities': entities,
+                'players': dict(self.players),
+                'pickups': self.pickups.dump(now),
+                'scores': {p_uuid: dict(score) for p_uuid, score in self.scores.items()},
+                'seqs': seqs,
+                'spawn_multipliers': multipliers,
+            }
+        return arrays, state
+
+    def restore(self, path: str) -> bool:
+        start = time.perf_counter()
+        try:
+            arrays, state = read_snapshot(path)
+            self.entities = EntityStore.load(arrays, state['entities'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f'restore: Could not restore from {path}, starting a new world: {e}')
+            return False
+        now = time.time()
+        self.players = state['players']
+        self.pickups.load(state['pickups'], now)
+        self.scores = state['scores']
+        self.resume_seq = state['seqs']
+        self.spawn_multipliers = state['spawn_multipliers']
+        self.restored_players = {p_uuid: now + self.restore_grace for p_uuid, player in self.players.items()
+                                 if player['is_alive']}
+        for e_uuid in self.entities.alive():
+            self.mark_dirty(e_uuid)
+        for p_uuid in self.players:
+            self.mark_dirty(p_uuid)
+        logger.info(f'restore: Restored {len(self.entities)} enemies, {len(self.players)} players and '
+                    f'{len(self.pickups)} pickups from {path} in {(time.perf_counter() - start) * 1000:.1f}ms, '
+                    f'snapshot is {now - state["time"]:.1f}s old')
+        return True
+
+    def expire_restored_players(self):
+        # Players from a restored snapshot that never came back are dropped like a disconnect
+        now = time.time()
+        for p_uuid in [p for p, deadline in self.restored_players.items() if deadline <= now]:
+            del self.restored_players[p_uuid]
+            self.resume_seq.pop(p_uuid, None)
+            self.spawn_multipliers.pop(p_uuid, None)
+            if not self.connected_clients.get(p_uuid):
+                logger.info(f'expire_restored_players: {p_uuid} did not reconnect')
+                self.remove_entity(p_uuid)
+                self.queue_event(None, 'remove', {p_uuid: now})
+
+    def queue_event(self, sender_id: str|None, key: str, payload: dict):
+        self.pending_events.append((sender_id, key, payload))
+
+    def update_pickups(self):
+        players = sum(1 for player in self.players.values() if player['is_alive'])
+        added, removed = self.pickups.update(time.time(), players)
+        if added:
+            self.queue_event(None, 'pickups', added)
+        if removed:
+            self.queue_event(None, 'pickups_removed', removed)
+
+    def new_enemy(self) -> str:
+        e_uuid = str(uuid.uuid4())
+        self.entities[e_uuid] = {
+                'type': 'enemy',
+                'location': {
+                    'x': choice([randint(0, 128), randint(1152, 1280)]), 
+                    'y': choice([randint(0, 128), randint(592, 720)]),
+                    'width' : 20,
+                    'height' : 20
+                },
+                'velocity': {'x': 0, 'y': 0},
+                'sprite': None,
+                'facing_left': False,
+                'target': None,
+                'is_alive': False,
+                'hp': 100,
+                'damage': 10
+            }
+        return e_uuid
+
+    def put_enemy(self, e_uuid: str, entity: dict):
+        # The store keeps the free pool and target lookups in step with the columns
+        self.entities[e_uuid] = entity
+        self.mark_dirty(e_uuid)
+
+    def update_entity(self, e_uuid: str, **fields):
+        # Replace rather than mutate, snapshot history keeps references to the old dict
+        if e_uuid in self.entities:
+            self.put_enemy(e_uuid, {**self.entities[e_uuid], **fields})
+        else:
+            self.players[e_uuid] = {**self.players[e_uuid], **fields}
+            self.mark_dirty(e_uuid)
+
+    def mark_dirty(self, e_uuid: str):
+        self.dirty_entities.add(e_uuid)
+        entity = self.entities.get(e_uuid) or self.players.get(e_uuid)
+        if entity is None:
+            return
+        if entity['type'] == 'enemy' and not entity['is_alive']:
+            self.grid.remove(e_uuid)
+        else:
+            location = entity['location']
+            self.grid.update(e_uuid, location['x'] + location.get('width', 0) / 2,
+                             location['y'] + location.get('height', 0) / 2)
+
+    def update_interest(self, client_id: str):
+        position = self.grid.position(client_id)
+        if self.interest_radius is None or position is None:
+            # No player yet, send everything
+            self.client_interest.pop(client_id, None)
+            return
+        x, y = position
+        entering = self.grid.query(x, y, self.interest_radius)
+        staying = self.grid.query(x, y, self.interest_radius + self.interest_hysteresis)
+        self.client_interest[client_id] = entering | (self.client_interest.get(client_id, set()) & staying)
+
+    def in_interest(self, client_id: str, x: float, y: float) -> bool:
+        position = self.grid.position(client_id)
+        if self.interest_radius is None or position is None:
+            return True
+        radius = self.interest_radius + self.interest_hysteresis
+        return (position[0] - x) ** 2 + (position[1] - y) ** 2 <= radius * radius
+
+    def filter_event(self, client_id: str, key: str, payload: dict) -> dict:
+        if key == 'particles':
+            return {p_uuid: particle for p_uuid, particle in payload.items()
+                    if self.in_interest(client_id, particle['origin']['x'], particle['origin']['y'])}
+        if key == 'spawn':
+            # Clients only act on spawns targeting their own player
+            return {e_uuid: entity for e_uuid, entity in payload.items() if entity['target'] == client_id}
+        return payload
+
+    def client_view(self, client_id: str) -> dict[str,dict]:
+        # Clients simulate their own player and the enemies targeting it,
+        # so there is no point sending those back to them
+        nearby = self.client_interest.get(client_id)
+        if nearby is None:
+            view = {e_uuid: self.entities[e_uuid] for e_uuid in self.entities.alive(exclude_target=client_id)}
+            view.update({p_uuid: player for p_uuid, player in self.players.items() if p_uuid != client_id})
+            return view
+        view = {}
+        for e_uuid in nearby:
+            if e_uuid in self.entities:
+                entity = self.entities[e_uuid]
+                if entity['is_alive'] and entity['target'] != client_id:
+                    view[e_uuid] = entity
+            elif e_uuid != client_id and e_uuid in self.players:
+                view[e_uuid] = self.players[e_uuid]
+        return view
+
     async def send_update(self):
-        await self.broadcast(None, {"entities": {**self.entities, **self.players}})
+        # Shared between clients so identical partial updates are only encoded once
+        memo = {}
+        now = time.time()
+        live_pickups = dict(self.pickups.pickups)
+        for client_id, lst in self.connected_clients.items():
+            if not lst or client_id not in self.fanout.channels:
+                continue
+            self.fanout.channels[client_id].offset = lst[1]
+            message = {}
+            if self.dirty_entities or client_id in self.needs_full_update:
+                self.update_interest(client_id)
+                message = self.client_history[client_id].delta(self.client_view(client_id), memo) or {}
+                if message:
+                    # Lets the client place the snapshot in time for interpolation
+                    message['time'] = now
+            if client_id in self.needs_full_update or self.resync_pickups:
+                # The whole set, in case a change went missing, clients drop any pickup not in it
+                message['pickups_live'] = live_pickups
+            if client_id in self.needs_full_update:
+                if self.leaderboard.entries:
+                    message['scores'] = self.leaderboard.board()
+            for sender_id, key, payload in self.pending_events:
+                if sender_id != client_id:
+                    payload = self.filter_event(client_id, key, payload)
+                    if payload:
+                        message.setdefault(key, {}).update(payload)
+            if message:
+                self.fanout.send(client_id, message)
+        self.fanout.end_tick()
+        self.needs_full_update.clear()
+        self.resync_pickups = False
+        self.dirty_entities.clear()
+        self.pending_events.clear()
 
     async def handler(self, websocket, path):
         # Wait for the initial message containing the UUID
         try:
             initial_message = await websocket.recv()
-            data = json.loads(initial_message)
+            data = decode(initial_message)
             client_id = data.get("uuid")
-            client_offset = time.time() - data.get('time')
             if not client_id:
                 logger.error("No UUID provided by client. Closing connection.")
                 await websocket.close()
                 return
+            if self.capture:
+                self.capture.connect(client_id, time.time(), initial_message)
+            await self.add_client(client_id, websocket, data)
+
+            # Messages are applied by the tick loop, not as they arrive
+            async for message in websocket:
+                if self.capture:
+                    self.capture.message(client_id, time.time(), message)
+                await self.update_queue.put((client_id, message))
 
-            self.connected_clients[client_id] = [websocket, client_offset, self.enemy_spawn_rate['multiplyer']]
-            logger.info(f"Client connected: {client_id}")
-            # add New enemy targeting the new player
+        finally:
+            if self.capture:
+                self.capture.disconnect(client_id, time.time())
+            self.drop_client(client_id)
+
+    async def add_client(self, client_id: str, websocket, data: dict):
+        """
+        Set up a client from its handshake, websocket only needs send and close
+        """
+        client_offset = time.time() - data.get('time')
+        self.connected_clients[client_id] = [websocket, client_offset,
+                                             self.spawn_multipliers.pop(client_id, self.enemy_spawn_rate['multiplyer'])]
+        self.restored_players.pop(client_id, None)
+        logger.info(f"Client connected: {client_id}")
+        # The handshake reply is always JSON, after it the client knows what we'll send
+        codec = negotiate(data.get('codecs'))
+        reply = {'codec': codec.name}
+        if self.room is not None:
+            reply['room'] = self.room
+        await websocket.send(JSON.encode(reply))
+        self.fanout.add(client_id, websocket, codec)
+        logger.info(f"Client {client_id} using {codec.name} codec")
+        # add New enemy targeting the new player, unless it's back after a restart and still has some
+        if not self.entities.targeting(client_id):
             await self.spawn_enemies(client_id, randint(self.enemy_spawn_rate['minimum'],
                 self.enemy_spawn_rate['respawn']))
 
-            # Broadcast the combined message to all connected clients
-            await self.broadcast(None, {"entities": self.entities})
+        # Send the whole world to the new client on the next tick
+        self.client_history[client_id] = SnapshotHistory(seq=self.resume_seq.pop(client_id, 0))
+        self.needs_full_update.add(client_id)
 
-            async for message in websocket:
-                await self.handle_message(client_id, message)
-
-        finally:
-            removals = self.remove_entity(client_id)
-            await asyncio.sleep(0.1)
+    def drop_client(self, client_id: str):
+        if client_id in self.connected_clients and self.connected_clients[client_id] is None:
+            return  # already gone, closed by close_client before its handler noticed
+        self.remove_entity(client_id)
+        self.queue_event(None, 'remove', {client_id: time.time()})
 
-            await self.broadcast(None, {"remove": removals})
+    def close_client(self, client_id: str):
+        """
+        Drop a client now and close its connection in the background
+        """
+        websocket = self.connected_clients[client_id][0]
+        self.drop_client(client_id)
+        asyncio.get_event_loop().create_task(websocket.close())
 
     async def handle_message(self, client_id, message):
         logger.debug(f"Received message from {client_id}: {message}")
         # Update the last message time
         self.last_message_time = asyncio.get_event_loop().time()
-        data = json.loads(message)
+        sizes = {}
+        data = decode(message, sizes)
+        size = len(message)
+        for key, section in sizes.items():
+            self.metrics.inc('bytes_total', section, direction='in', type=key)
+            size -= section
+        self.metrics.inc('bytes_total', size, direction='in', type='other')
         if isinstance(data, dict):
-            await self.update_queue.put(True)
+            for key in data:
+                if key not in ('uuid', 'name', 'time'):
+                    self.metrics.inc('messages_total', direction='in', type=key)
             if 'time' in data:
                 self.connected_clients[client_id][1] = time.time() - data['time']
+            if 'ack' in data and client_id in self.client_history:
+                self.client_history[client_id].acknowledge(data['ack'])
             if 'entities' in data.keys():
                 for r_uuid, remote_entity in data['entities'].items():
                     if r_uuid in self.entities.keys():
-                        self.entities[r_uuid] = remote_entity
+                        self.put_enemy(r_uuid, remote_entity)
                     elif r_uuid in self.players.keys():
                         if not remote_entity['is_alive'] and self.players[r_uuid]['is_alive']:
                             self.remove_enemys_targeting(r_uuid)
@@ -136,30 +482,30 @@ class WebSocketServer:
                     else:
                         try:
                             if remote_entity['type'] == 'enemy':
-                                self.entities[r_uuid] = remote_entity
+                                self.put_enemy(r_uuid, remote_entity)
                             elif remote_entity['type'] == 'player':
                                 self.players[r_uuid] = remote_entity
                         except Exception as e:
                             logger.info(f'\n\n{r_uuid=} {remote_entity=}\n\n')
-                await self.broadcast(client_id, {'entities': data['entities']})
+                    self.mark_dirty(r_uuid)
             if 'killed' in data:
                 for r_uuid, time_of_death in data['killed'].items():
                     if r_uuid in self.entities:
                         logger.info(f'handle_message: Killing {r_uuid=}')
-                        self.entities[r_uuid]['is_alive'] = False
-                        self.entities[r_uuid]['target'] = None
-                        self.entities[r_uuid]['location']['x'] = 1280
-                        self.entities[r_uuid]['location']['y'] = 720
-                await self.broadcast(client_id, {'killed': data['killed']})
+                        location = {**self.entities[r_uuid]['location'], 'x': 1280, 'y': 720}
+                        self.update_entity(r_uuid, is_alive=False, target=None, location=location)
+                self.queue_event(client_id, 'killed', data['killed'])
             if 'particles' in data:
                 for p in data['particles']:
                     data['particles'][p]['start_time'] += self.connected_clients[client_id][1]
-                await self.broadcast(client_id, {'particles': data['particles']})
+                self.queue_event(client_id, 'particles', data['particles'])
 
             if 'pickups' in data:
-                for k,v in data['pickups'].items():
-                    self.pickups[k] = v
-                await self.broadcast(client_id, {'pickups': self.pickups})
+                # Clients only tell us what they collected, the first one to claim a pickup has it
+                collected = {k: time.time() for k, v in data['pickups'].items()
+                             if v.get('complete') and self.pickups.collect(k)}
+                if collected:
+                    self.queue_event(client_id, 'pickups_removed', collected)
 
             if 'score' in data.keys():
                 if data['uuid'] in self.scores.keys():
@@ -175,45 +521,37 @@ class WebSocketServer:
                         await self.spawn_enemies(data['uuid'],randint(self.enemy_spawn_rate['minimum'],
                             self.enemy_spawn_rate['score']))
                     self.scores[data['uuid']]['current_score'] = data['score']
-                    if data['score'] > self.scores[data['uuid']]['score']:
-                        self.scores[data['uuid']] = {'name': data['name'], 'score': data['score'], 'current_score': data['score']}
-                        logger.debug(f'Set score for {data["uuid"]} to {self.scores[data["uuid"]]}')
-                    elif data['name'] != self.scores[data['uuid']]['name']:
-                        self.scores[data['uuid']]['name'] = data['name']
                 else:
-                    self.scores[data['uuid']] = {'name': data['name'], 'score': data['score'], 'current_score': data['score']}
-                    logger.debug(f'Set score for {data["uuid"]} to {self.scores[data["uuid"]]}')
-                # await self.broadcast(None, {'scores':self.scores})
+                    self.scores[data['uuid']] = {'current_score': data['score']}
+                # Goes out with a later tick, if it changed the top scores
+                if self.leaderboard.update(data['uuid'], data['name'], data['score']):
+                    logger.debug(f'Leaderboard changed by {data["uuid"]} scoring {data["score"]}')
 
     async def broadcast(self, sender_id, message):
         logger.debug(f'Broadcast Message: {message=}')
-        for client_id, lst in self.connected_clients.items():
-            if lst:
-                websocket, offset, _ = lst
-                message['offset'] = offset
-                if client_id != sender_id and websocket:  # Don't send the message back to the sender
-                    try:
-                        await websocket.send(json.dumps(message))
-                        logger.debug(f"Sent message to {client_id}: {message}")
-                    except Exception as e:
-                        logger.error(f"Error sending message to {client_id}: {e}")
+        with self.broadcast_latency.time():
+            for client_id, lst in self.connected_clients.items():
+                if lst and client_id in self.fanout.channels:
+                    self.fanout.channels[client_id].offset = lst[1]
+            self.fanout.broadcast(sender_id, message)
+            self.fanout.end_tick()
 
     async def spawn_enemies(self, target: str, number_to_spawn: int):
         logger.info(f'spawn_enemies: {target=} {number_to_spawn=}')
-        spawned = []
-        for e_uuid, entity in self.entities.items():
-            if not entity['is_alive'] and len(spawned) < number_to_spawn:
-                logger.info(f'spawn_enemy: Spawning {e_uuid=} to target {target=}')
-                entity['is_alive'] = True
-                entity['target'] = target
-                entity['location']['x'] = choice([randint(0, 128), randint(1152, 1280)])
-                entity['location']['y'] = choice([randint(0, 128), randint(592, 720)])
-                spawned.append(e_uuid)
-        if not spawned:
-            logger.error('spawn_enemys: No Enemies to Spawn')
-        else:
-            entities = {e:self.entities[e] for e in self.entities if e in spawned}
-            await self.broadcast(None, {'spawn': entities})
+        spawned = {}
+        for _ in range(number_to_spawn):
+            e_uuid = self.entities.first_free()
+            if e_uuid is None:
+                e_uuid = self.new_enemy()
+                logger.info(f'spawn_enemies: Pool empty, grew it to {len(self.entities)} enemies')
+            logger.info(f'spawn_enemy: Spawning {e_uuid=} to target {target=}')
+            location = {**self.entities[e_uuid]['location'],
+                        'x': choice([randint(0, 128), randint(1152, 1280)]),
+                        'y': choice([randint(0, 128), randint(592, 720)])}
+            self.update_entity(e_uuid, is_alive=True, target=target, location=location)
+            spawned[e_uuid] = self.entities[e_uuid]
+        if spawned:
+            self.queue_event(None, 'spawn', spawned)
 
     def remove_entity(self, entity_id):
         logger.info(f'remove_entity: Received removal for {entity_id}')
@@ -221,26 +559,40 @@ class WebSocketServer:
             logger.info(f'remove_entity: Received disconnect from {entity_id}')
             logger.debug(f'remove_entity: Removing from connected clients')
             self.connected_clients[entity_id] = None
+            self.client_history.pop(entity_id, None)
+            self.fanout.remove(entity_id)
+            self.client_interest.pop(entity_id, None)
+            self.scores.pop(entity_id, None)
         if entity_id in self.entities.keys():
-            self.entities[entity_id]['is_alive'] = False
+            self.update_entity(entity_id, is_alive=False)
         if entity_id in self.players.keys():
-            self.players[entity_id]['is_alive'] = False
+            self.update_entity(entity_id, is_alive=False)
         self.remove_enemys_targeting(entity_id)
+        self.entities.forget_target(entity_id)
 
 
     def remove_enemys_targeting(self, entity_id:str):
         logger.debug(f'remove_enemys_targeting: Removing enemies targeting {entity_id}')
-        for e_uuid, entity in self.entities.items():
-            if entity['target'] == entity_id:
-                logger.info(f'remove_enemys_targeting: killing {e_uuid=} which was targeting {entity_id=}')
-                entity['is_alive'] = False
-                entity['target'] = None
+        for e_uuid in self.entities.targeting(entity_id):
+            logger.info(f'remove_enemys_targeting: killing {e_uuid=} which was targeting {entity_id=}')
+            self.update_entity(e_uuid, is_alive=False, target=None)
         
     
-    def run(self, update_function=None, host='localhost', port=8765):
+    def run(self, update_function=None, host='localhost', port=8765, metrics_port: int|None=None,
+            metrics_file: str|None=None, metrics_interval: float=10, metrics_host: str='localhost'):
         start_server = websockets.serve(self.handler, host, port)
         asyncio.get_event_loop().run_until_complete(start_server)
         logger.info(f"WebSocket server started on ws://{host}:{port}")
+        if metrics_port or metrics_file:
+            asyncio.get_event_loop().create_task(self.metrics.watch_loop_lag(self.loop_lag))
+        if metrics_port:
+            asyncio.get_event_loop().run_until_complete(self.metrics.serve(metrics_host, metrics_port))
+        if metrics_file:
+            asyncio.get_event_loop().create_task(self.metrics.dump(metrics_file, metrics_interval))
+        if self.leaderboard.path:
+            asyncio.get_event_loop().create_task(self.leaderboard.persist())
+        if self.snapshot_file and self.snapshot_interval:
+            asyncio.get_event_loop().create_task(snapshot_loop(self, self.snapshot_file, self.snapshot_interval))
         # Start the periodic update task
         if update_function:
             asyncio.get_event_loop().create_task(update_function(self))
@@ -255,8 +607,20 @@ class WebSocketServer:
             loop.run_until_complete(self.shutdown())
 
     async def shutdown(self):
+        self.leaderboard.save()
+        if self.capture:
+            self.capture.close()
+        if self.snapshot_file:
+            # Last snapshot before the connections go, for a --restore straight after
+            try:
+                size = write_snapshot(self.snapshot_file, *self.capture_state())
+                logger.info(f'shutdown: Wrote {size} bytes of state to {self.snapshot_file}')
+            except OSError as e:
+                logger.error(f'shutdown: Could not write snapshot to {self.snapshot_file}: {e}')
         # Close all connections gracefully
         logger.info("Closing all client connections...")
+        for client_id in list(self.fanout.channels):
+            self.fanout.remove(client_id)
         for client_id, lst in self.connected_clients.items():
             if isinstance(lst, list):
                 websocket, _, __ = lst
@@ -264,6 +628,26 @@ class WebSocketServer:
                     await websocket.close()
                     logger.info(f"Closed connection for client: {client_id}")
 
+async def update_entities(server: WebSocketServer):
+    loop = asyncio.get_event_loop()
+    next_tick = loop.time()
+    while server.running:
+        current_time = loop.time()
+        logger.debug(f"update_entities: {(current_time - next_tick)=} {server.update_interval}")
+        try:
+            await server.tick()
+        except Exception as e:
+            # Keep ticking, a failed tick's changes are still dirty and go out with the next one
+            logger.error(f"update_entities: Tick failed: {e!r}")
+        # Schedule against a fixed timeline so slow ticks don't drift the rate
+        next_tick += server.update_interval
+        delay = next_tick - loop.time()
+        if delay < 0:
+            logger.warning(f"update_entities: Tick overran by {-delay:.4f}s")
+            next_tick = loop.time()
+            delay = 0
+        await asyncio.sleep(delay)
+
 if __name__ == "__main__":
     server = WebSocketServer()
     server.run()
@@ -1,8 +1,7 @@
-from server import WebSocketServer
-from random import randint, choice
-import asyncio
+from server import WebSocketServer, update_entities
+from fanout import POLICIES
+from rooms import RoomRouter
 import logging
-import pygame as pg
 import argparse
 
 # Configure logging
@@ -12,31 +11,49 @@ logging.basicConfig(level=logging.INFO)
 parser = argparse.ArgumentParser()
 parser.add_argument("-l", "--listen", help="Listen IP", required=False, default='localhost')
 parser.add_argument("-p", "--port", help="Server port to connect to, or listen on as server", required=False, default=8765)
+parser.add_argument("-t", "--tick-rate", help="Server updates per second (e.g. 20, 30, 60)", type=float, required=False, default=30)
+parser.add_argument("-q", "--queue-size", help="Frames queued per client before backpressure kicks in", type=int, required=False, default=8)
+parser.add_argument("-b", "--backpressure", help="What to do with clients that fall behind", choices=POLICIES, required=False, default=POLICIES[0])
+parser.add_argument("-r", "--interest-radius", help="Only send clients entities within this many pixels of their player, 0 sends everything", type=float, required=False, default=1500)
+parser.add_argument("--interest-hysteresis", help="Extra distance before an entity in view is dropped again", type=float, required=False, default=200)
+parser.add_argument("-m", "--metrics-port", help="Serve Prometheus metrics on this port, 0 to not serve them", type=int, required=False, default=0)
+parser.add_argument("--metrics-host", help="Address the metrics are served on, separate from --listen so they aren't public by default", required=False, default='localhost')
+parser.add_argument("--metrics-file", help="Also write the metrics to this file every --metrics-interval seconds", required=False, default=None)
+parser.add_argument("--metrics-interval", help="Seconds between metrics file writes", type=float, required=False, default=10)
+parser.add_argument("--scores-file", help="File the leaderboard is kept in, empty to not keep it", required=False, default='scores.json')
+parser.add_argument("--leaderboard-size", help="Top scores kept and sent to clients", type=int, required=False, default=10)
+parser.add_argument("--leaderboard-interval", help="Minimum seconds between leaderboard updates to clients", type=float, required=False, default=1)
+parser.add_argument("--snapshot-file", help="File the server's state is written to and restored from, empty to not write it", required=False, default='state.npz')
+parser.add_argument("--snapshot-interval", help="Seconds between state snapshots, 0 to only write one on shutdown", type=float, required=False, default=10)
+parser.add_argument("--restore", help="Start from the state in --snapshot-file instead of a new world", action='store_true')
+parser.add_argument("--restore-grace", help="Seconds restored players get to reconnect before they are removed", type=float, required=False, default=30)
+parser.add_argument("--pickup-resync", help="Seconds between sending clients every live pickup, 0 to only send changes", type=float, required=False, default=10)
+parser.add_argument("--capture", help="Record every message received to this file, for replay.py", required=False, default=None)
+parser.add_argument("--capture-max-mb", help="Size a capture file is rotated at", type=float, required=False, default=64)
+parser.add_argument("--capture-backups", help="Rotated capture files kept", type=int, required=False, default=5)
+parser.add_argument("--rooms", help="Run up to this many rooms, each in its own process behind this one, 0 runs a single world in this process", type=int, required=False, default=0)
+parser.add_argument("--room-size", help="Players in a room before the next player gets a new one", type=int, required=False, default=8)
+parser.add_argument("--room-port", help="Port of the first room's process, the others follow on from it (default port + 1)", type=int, required=False, default=None)
+parser.add_argument("--rooms-file", help="JSON file of spawn rate overrides by room name", required=False, default='rooms.json')
 parser.add_argument("-d", "--debug", help="Run with debug flags", action='store_true')
 args = parser.parse_args()
 
-async def update_entities(server: WebSocketServer):
-    last_update_time = 0
-    while server.running:
-        current_time = asyncio.get_event_loop().time()
-        logger.debug(f"{(current_time - last_update_time)=} {server.update_interval}")
-        # if current_time - last_update_time > server.update_interval:
-            # dt = current_time - last_update_time
-            # logger.debug("Running update")
-            # updates = await check_queue(server)
-            # last_update_time = current_time
-            # if updates: 
-            #   await server.send_update()
-        await asyncio.sleep(0.01)  # Adjust sleep time as needed
-
-async def check_queue(server: WebSocketServer):
-    updates = False
-    while not server.update_queue.empty():
-        server.update_queue.get()
-        server.update_queue.task_done()
-        updates = True
-    return updates
-
 if __name__ == '__main__':
-    server = WebSocketServer()
-    server.run(update_entities, host=args.listen, port=args.port)
\ No newline at end of file
+    server_options = dict(tick_rate=args.tick_rate, max_queue=args.queue_size, backpressure=args.backpressure,
+                          interest_radius=args.interest_radius or None, interest_hysteresis=args.interest_hysteresis,
+                          scores_file=args.scores_file or None, leaderboard_size=args.leaderboard_size,
+                          leaderboard_interval=args.leaderboard_interval, snapshot_file=args.snapshot_file or None,
+                          snapshot_interval=args.snapshot_interval, restore=args.restore, restore_grace=args.restore_grace,
+                          capture_file=args.capture, capture_max_bytes=int(args.capture_max_mb * 1024 * 1024),
+                          capture_backups=args.capture_backups, pickup_resync=args.pickup_resync)
+    if args.rooms:
+        # Each room's metrics are on their own port, counting up from --metrics-port
+        router = RoomRouter(max_rooms=args.rooms, room_size=args.room_size,
+                            room_port=args.room_port or int(args.port) + 1, metrics_port=args.metrics_port or None,
+                            rooms_file=args.rooms_file, server_options=server_options, metrics_host=args.metrics_host,
+                            metrics_file=args.metrics_file, metrics_interval=args.metrics_interval)
+        router.run(host=args.listen, port=args.port)
+    else:
+        server = WebSocketServer(**server_options)
+        server.run(update_entities, host=args.listen, port=args.port, metrics_port=args.metrics_port,
+                   metrics_file=args.metrics_file, metrics_interval=args.metrics_interval, metrics_host=args.metrics_host)
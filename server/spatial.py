@@ -0,0 +1,67 @@
+"""
+Uniform grid spatial index of entity positions
+"""
+import logging
+from math import floor
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+class SpatialGrid:
+    def __init__(self, cell_size: float = 256) -> None:
+        self.cell_size = cell_size
+        self._cells: dict[tuple[int,int], set[str]] = {}
+        self._positions: dict[str, tuple[float,float]] = {}
+        self._cell_of: dict[str, tuple[int,int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, e_uuid: str) -> bool:
+        return e_uuid in self._positions
+
+    def _cell(self, x: float, y: float) -> tuple[int,int]:
+        return floor(x / self.cell_size), floor(y / self.cell_size)
+
+    def update(self, e_uuid: str, x: float, y: float) -> None:
+        self._positions[e_uuid] = (x, y)
+        cell = self._cell(x, y)
+        old_cell = self._cell_of.get(e_uuid)
+        if cell == old_cell:
+            return
+        if old_cell is not None:
+            self._discard(e_uuid, old_cell)
+        self._cells.setdefault(cell, set()).add(e_uuid)
+        self._cell_of[e_uuid] = cell
+
+    def remove(self, e_uuid: str) -> None:
+        cell = self._cell_of.pop(e_uuid, None)
+        if cell is not None:
+            self._discard(e_uuid, cell)
+            del self._positions[e_uuid]
+
+    def _discard(self, e_uuid: str, cell: tuple[int,int]) -> None:
+        members = self._cells[cell]
+        members.discard(e_uuid)
+        if not members:
+            del self._cells[cell]
+
+    def position(self, e_uuid: str) -> tuple[float,float]|None:
+        return self._positions.get(e_uuid)
+
+    def query(self, x: float, y: float, radius: float) -> set[str]:
+        """
+        Ids of everything within radius of (x, y)
+        """
+        found = set()
+        radius2 = radius * radius
+        min_x, min_y = self._cell(x - radius, y - radius)
+        max_x, max_y = self._cell(x + radius, y + radius)
+        positions = self._positions
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                for e_uuid in self._cells.get((cx, cy), ()):
+                    ex, ey = positions[e_uuid]
+                    if (ex - x) ** 2 + (ey - y) ** 2 <= radius2:
+                        found.add(e_uuid)
+        return found
@@ -0,0 +1,16 @@
+"""
+Small statistics helpers shared by the server tools and the client profiler
+
+Nothing here imports another server module, so the client can use it as
+server.stats.
+"""
+import math
+
+def percentile(values: list[float], pct: float) -> float:
+    """
+    Nearest rank percentile, nan when there are no values
+    """
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
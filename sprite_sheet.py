@@ -1,7 +1,78 @@
+from collections import OrderedDict
+from typing import Callable
+
 import pygame as pg
 
+# Masks of the plain circles drawn for entities without a sprite, by radius
+_circle_masks: dict[int, pg.Mask] = {}
+
+def frame_masks(surface: pg.Surface, width: int, height: int) -> dict[tuple[int,bool], pg.Mask]:
+    """
+    Collision mask of every frame of a sprite sheet, keyed by (frame index, flip)
+    """
+    masks = {}
+    for flip in (False, True):
+        sheet = pg.transform.flip(surface, True, False) if flip else surface
+        for index in range(max(surface.get_width() // width, 1)):
+            frame = pg.Surface((width, height), pg.SRCALPHA)
+            frame.blit(sheet, (0,0), pg.Rect(index * width, 0, width, height))
+            masks[(index, flip)] = pg.mask.from_surface(frame)
+    return masks
+
+def circle_mask(radius: int = 10) -> pg.Mask:
+    """
+    Mask of the circle AnimatedSprite draws when it has no sprite sheet
+    """
+    if radius not in _circle_masks:
+        image = pg.Surface((20, 20), pg.SRCALPHA)
+        pg.draw.circle(image, (255,255,255,255), (radius,radius), radius=radius, width=0)
+        surface = pg.Surface((radius*2, radius*2), pg.SRCALPHA)
+        surface.blit(image, (0,0))
+        _circle_masks[radius] = pg.mask.from_surface(surface)
+    return _circle_masks[radius]
+
+def tint(surface: pg.Surface, color=None, flip: bool=False, area: pg.Rect=None) -> pg.Surface:
+    """
+    Copy of surface (or the area of it) tinted with color and flipped horizontally,
+    area is taken from the flipped surface, the same way AnimatedSprite always drew
+    """
+    tinted = surface.copy()
+    if color:
+        tinted.fill(color,None,pg.BLEND_RGBA_MIN)
+    if flip:
+        tinted = pg.transform.flip(tinted,True,False)
+    return tinted.subsurface(area).copy() if area else tinted
+
+class RenderCache:
+    """
+    Least recently used cache of prebuilt surfaces
+    """
+    def __init__(self, max_size: int = 512) -> None:
+        self.max_size = max_size
+        self._surfaces: OrderedDict[tuple, pg.Surface] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._surfaces)
+
+    def get(self, key: tuple, build: Callable[[], pg.Surface]) -> pg.Surface:
+        surface = self._surfaces.get(key)
+        if surface is not None:
+            self._surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+        self.misses += 1
+        surface = self._surfaces[key] = build()
+        if len(self._surfaces) > self.max_size:
+            self._surfaces.popitem(last=False)
+        return surface
+
+# Tinted circles for sprites without a sheet, shared by every AnimatedSprite
+_circle_frames = RenderCache(64)
+
 class SpriteSet:
-    def __init__(self, sprites:dict[str,dict[str:str]]) -> None:
+    def __init__(self, sprites:dict[str,dict[str:str]], cache_size: int = 512) -> None:
         """
         sprites = {
             'player': {
@@ -12,12 +83,16 @@ class SpriteSet:
         }
         """
         self._sprites = {}
+        self.render_cache = RenderCache(cache_size)
         for name, sprite in sprites.items():
             surface = pg.image.load(sprite['file']).convert_alpha()
             self._sprites[name] = {
                 'surface': surface,
                 'width':sprite['width'],
                 'height':sprite['height'],
+                'masks': frame_masks(surface, sprite['width'], sprite['height']),
+                'name': name,
+                'sprite_set': self,
                 }
 
     def get_sprite(self, name:str) -> pg.Surface:
@@ -26,21 +101,41 @@ class SpriteSet:
         else:
             return None
 
+    def get_mask(self, name:str, frame:int, flip:bool) -> pg.Mask|None:
+        sprite = self._sprites.get(name)
+        return sprite['masks'].get((frame, flip)) if sprite else None
+
+    def get_frame(self, name:str, frame:int, color=None, flip:bool=False) -> pg.Surface:
+        """
+        Frame of sprite name tinted with color and flipped, built once and then reused
+        """
+        sprite = self._sprites[name]
+        key = (name, frame, tuple(color) if color else None, bool(flip))
+        area = pg.Rect(frame * sprite['width'], 0, sprite['width'], sprite['height'])
+        return self.render_cache.get(key, lambda: tint(sprite['surface'], color, flip, area))
+
 class AnimatedSprite(pg.sprite.Sprite):
     def __init__(self, sprite_details: dict[str,int|pg.Surface], location:pg.Vector2=None, radius:int=10) -> None:
         self.image = None
         self._frame = None
         self.rect = None
+        self._masks = None
+        self._sprite_set = None
+        self._name = None
         if not location: location = pg.Vector2(0,0)
         if sprite_details:
             self.image = sprite_details['surface']
             self._frame = pg.Rect(0,0,sprite_details['width'],sprite_details['height'])
+            self._masks = sprite_details.get('masks')
+            self._sprite_set = sprite_details.get('sprite_set')
+            self._name = sprite_details.get('name')
             self.rect = pg.Rect(location.x,location.y,self._frame.width, self._frame.height)
         else:
             if not radius: radius = 10
             self.image = pg.Surface((20, 20), pg.SRCALPHA)
             pg.draw.circle(self.image, (255,255,255,255), (radius,radius), radius=radius, width=0)
             self.rect = pg.Rect(location.x-radius,location.y-radius,radius*2, radius*2)
+            self._radius = radius
 
         self._frame_update = 1000/10
         self._last_frame = 0
@@ -59,15 +154,37 @@ class AnimatedSprite(pg.sprite.Sprite):
                 self._last_frame = current_time
 
     def get_mask(self, flip) -> pg.Mask:
+        if self._masks:
+            mask = self._masks.get((self._frame.x // self._frame.width, bool(flip)))
+            if mask is not None: return mask
+        elif not self._frame:
+            return circle_mask(self._radius)
+        return self._build_mask(flip)
+
+    def _build_mask(self, flip) -> pg.Mask:
         flipped = pg.transform.flip(self.image.copy(),True,False) if flip else self.image.copy()
         surface = pg.Surface((self.rect.width,self.rect.height), pg.SRCALPHA)
         surface.blit(flipped, (0,0), self._frame)
         return pg.mask.from_surface(surface)
 
-    def draw(self, screen: pg.Surface, color=None, flip: bool=False):
-        tinted = self.image.copy()
-        if color:
-            tinted.fill(color,None,pg.BLEND_RGBA_MIN)
-        screen.blit(pg.transform.flip(tinted,True,False) if flip else tinted, self.rect, self._frame)
+    def get_surface(self, color=None, flip: bool=False) -> pg.Surface:
+        """
+        The current frame as it should be drawn, from the render cache where possible
+        """
+        if self._sprite_set:
+            return self._sprite_set.get_frame(self._name, self._frame.x // self._frame.width, color, flip)
+        if not self._frame:
+            key = (self._radius, tuple(color) if color else None, bool(flip))
+            return _circle_frames.get(key, lambda: tint(self.image, color, flip))
+        return tint(self.image, color, flip, self._frame)
+
+    def draw(self, screen: pg.Surface, color=None, flip: bool=False, batch: list|None=None):
+        """
+        Blit the current frame to screen, or add it to batch for a later Surface.blits
+        """
+        if batch is None:
+            screen.blit(self.get_surface(color, flip), self.rect)
+        else:
+            batch.append((self.get_surface(color, flip), self.rect.copy()))
         # mask = self.get_mask(flip)
         # screen.blit(mask.to_surface(),location)
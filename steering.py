@@ -0,0 +1,108 @@
+"""
+Batched enemy steering with NumPy
+
+Does what Entity.move_to_avoiding does for one enemy (seek the destination,
+push away from overlapping neighbours) for a whole list of enemies at once.
+Neighbours are found by binning rect centres into a grid and matching each
+cell against its 3x3 neighbourhood, all as array operations.
+"""
+import numpy as np
+import pygame as pg
+
+def rect_arrays(rects: list[pg.Rect]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (centres, sizes) of rects as float arrays of shape (n, 2)
+    """
+    centres = np.array([rect.center for rect in rects], dtype=np.float64).reshape(-1, 2)
+    sizes = np.array([rect.size for rect in rects], dtype=np.float64).reshape(-1, 2)
+    return centres, sizes
+
+def neighbour_pairs(centres: np.ndarray, cell_size: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Index pairs (i, j), i != j, of every centre within one grid cell of another.
+    Callers filter the candidates down to the ones that matter to them.
+    """
+    n = len(centres)
+    if n < 2:
+        return np.empty(0, np.intp), np.empty(0, np.intp)
+    cells = np.floor(centres / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0) - 1  # keep every neighbour's cell non-negative
+    stride = cells[:, 1].max() + 2
+    keys = cells[:, 0] * stride + cells[:, 1]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    firsts = []
+    seconds = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            wanted = keys + (dx * stride + dy)
+            start = np.searchsorted(sorted_keys, wanted, 'left')
+            counts = np.searchsorted(sorted_keys, wanted, 'right') - start
+            total = counts.sum()
+            if not total:
+                continue
+            # Expand every [start, start + count) range into flat indices
+            offsets = np.repeat(start - (np.cumsum(counts) - counts), counts)
+            firsts.append(np.repeat(np.arange(n), counts))
+            seconds.append(order[np.arange(total) + offsets])
+    if not firsts:
+        return np.empty(0, np.intp), np.empty(0, np.intp)
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    different = first != second
+    return first[different], second[different]
+
+def steering_velocities(centres: np.ndarray, sizes: np.ndarray, steer: np.ndarray, destination,
+                        max_velocity: np.ndarray) -> np.ndarray:
+    """
+    Velocities for the rects at indices steer: towards destination plus
+    away from any rect overlapping theirs, capped at max_velocity.
+    The rest of centres are obstacles only.
+    """
+    seek = np.asarray(destination, dtype=np.float64) - centres[steer]
+    seek_length = np.hypot(seek[:, 0], seek[:, 1])
+    np.divide(seek, seek_length[:, None], out=seek, where=seek_length[:, None] != 0)
+
+    separation = np.zeros_like(seek)
+    if len(centres) > 1:
+        steering = np.full(len(centres), -1, dtype=np.intp)
+        steering[steer] = np.arange(len(steer))
+        cell_size = max(sizes.max(), 1)
+        first, second = neighbour_pairs(centres, cell_size)
+        keep = steering[first] >= 0
+        first, second = first[keep], second[keep]
+        offset = centres[first] - centres[second]
+        distance = np.hypot(offset[:, 0], offset[:, 1])
+        # Rects overlap (as colliderect sees it) and the centre is inside the other's radius
+        overlap = np.all(np.abs(offset) * 2 < sizes[first] + sizes[second], axis=1)
+        keep = overlap & (distance > 0) & (distance < sizes[second, 0])
+        np.add.at(separation, steering[first[keep]], offset[keep])
+        separation_length = np.hypot(separation[:, 0], separation[:, 1])
+        np.divide(separation, separation_length[:, None], out=separation,
+                  where=separation_length[:, None] != 0)
+    return (seek + separation) * max_velocity[:, None]
+
+def steer_batch(entities: list, destination: pg.Vector2, obstacles: dict[str,pg.Rect], dt: float) -> None:
+    """
+    Move every entity towards destination while avoiding obstacles (which
+    should include the entities' own rects), like calling move_to_avoiding on
+    each of them but with every neighbour search and vector done in one pass.
+    """
+    if not entities:
+        return
+    rects = list(obstacles.values())
+    index = {id(rect): i for i, rect in enumerate(rects)}
+    steer = []
+    for entity in entities:
+        rect = entity.get_rect()
+        if id(rect) not in index:
+            index[id(rect)] = len(rects)
+            rects.append(rect)
+        steer.append(index[id(rect)])
+    centres, sizes = rect_arrays(rects)
+    steer = np.array(steer, dtype=np.intp)
+    max_velocity = np.array([e._max_velocity for e in entities], dtype=np.float64)
+    velocities = steering_velocities(centres, sizes, steer, (destination.x, destination.y), max_velocity)
+    for entity, (vx, vy) in zip(entities, velocities.tolist()):
+        entity._velocity.update(vx, vy)
+        entity.update(dt)
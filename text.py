@@ -0,0 +1,27 @@
+"""
+Process wide font registry and cache of rendered text
+
+SysFont lookups are slow and most labels (names, headings, scores that
+haven't changed) are the same from one frame to the next, so fonts are
+loaded once and rendered text is kept until it falls out of the cache.
+"""
+import pygame as pg
+
+from sprite_sheet import RenderCache
+
+_fonts: dict[tuple[str,int], pg.font.Font] = {}
+_text_cache = RenderCache(256)
+
+def get_font(name: str, size: int) -> pg.font.Font:
+    font = _fonts.get((name, size))
+    if font is None:
+        if not pg.font.get_init(): pg.font.init()
+        font = _fonts[(name, size)] = pg.font.SysFont(name, size)
+    return font
+
+def render_text(font: pg.font.Font, text: str, color=(0,0,0), antialias: bool=True) -> pg.Surface:
+    """
+    font.render(text, antialias, color), rendered once per (font, text, colour)
+    """
+    key = (font, text, tuple(color), antialias)
+    return _text_cache.get(key, lambda: font.render(text, antialias, color))